@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+from __future__ import with_statement
+
+import logging
+import logging.handlers
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+BACKENDS = {
+    'hg': 'versions.backends.hg',
+    'database': 'versions.backends.database',
+    }
+
+def create_data(scale):
+    """
+    Creates `scale` artists, each with two albums of five songs with lyrics, and a venue for every five artists.
+    """
+    from versions.base import revision
+    from versions.tests.models import Artist, Album, Song, Lyrics, Venue
+
+    with revision:
+        artists = []
+        for x in xrange(scale):
+            artist = Artist(name='Artist %s' % x)
+            artist.save()
+            artists.append(artist)
+            for y in xrange(2):
+                album = Album(artist=artist, title='Album %s-%s' % (x, y))
+                album.save()
+                for z in xrange(5):
+                    song = Song(album=album, title='Song %s-%s-%s' % (x, y, z), seconds=180 + z)
+                    song.save()
+                    Lyrics(song=song, text='Lyrics for song %s-%s-%s. ' % (x, y, z) * 20).save()
+
+        for x in xrange(0, scale, 5):
+            venue = Venue(name='Venue %s' % x)
+            venue.save()
+            venue.artists.add(*artists[x:x + 5])
+
+def summarize(timings):
+    """
+    Returns the count, mean, median, 95th percentile and maximum of a list of durations, in milliseconds.
+    """
+    timings = sorted(timings)
+    return {
+        'count': len(timings),
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[min(int(len(timings) * 0.95), len(timings) - 1)] * 1000,
+        'max_ms': timings[-1] * 1000,
+        }
+
+def benchmark_codecs(scale, backend):
+    from versions import codec
+    from versions.base import revision
+    from versions.tests.models import Artist, Album, Song, Lyrics, Venue
+
+    create_data(scale)
+    snapshots = []
+    for model in (Artist, Album, Song, Lyrics, Venue):
+        snapshots.extend([ revision.data(x) for x in model.objects.all() ])
+
+    results = {}
+    print 'Encoding %s snapshots of the test models.' % len(snapshots)
+    print '%-16s %12s %12s %14s' % ('codec', 'encode (ms)', 'decode (ms)', 'size (bytes)')
+    for name in ('pickle', 'json'):
+        for compress in (False, True):
+            started = time.time()
+            encoded = [ codec.encode(x, name, compress) for x in snapshots ]
+            encode_time = time.time() - started
+
+            started = time.time()
+            for x in encoded:
+                codec.decode(x)
+            decode_time = time.time() - started
+
+            label = compress and '%s+zlib' % name or name
+            results[label] = {
+                'encode_ms': encode_time * 1000,
+                'decode_ms': decode_time * 1000,
+                'size_bytes': sum([ len(x) for x in encoded ]),
+                }
+            print '%-16s %12.1f %12.1f %14s' % (label, results[label]['encode_ms'], results[label]['decode_ms'], results[label]['size_bytes'])
+    return results
+
+def benchmark_snapshots(scale, backend):
+    """
+    Measures the cost per save of building and encoding the snapshot of each of the test models,
+    with the related ids queried for every object, and collected in advance as `finish` does.
+    """
+    from versions.base import revision
+    from versions.tests.models import Artist, Album, Song, Lyrics, Venue
+
+    create_data(scale)
+    results = {}
+    print '%-16s %10s %14s %16s' % ('model', 'objects', 'queried (us)', 'prefetched (us)')
+    for model in (Artist, Album, Song, Lyrics, Venue):
+        instances = list(model.objects.all())
+
+        started = time.time()
+        for instance in instances:
+            revision.serialize(instance)
+        queried_time = time.time() - started
+
+        revision.prefetch_related(instances)
+        try:
+            started = time.time()
+            for instance in instances:
+                revision.serialize(instance)
+            prefetched_time = time.time() - started
+        finally:
+            revision._state.reset()
+
+        name = model.__name__.lower()
+        results[name] = {
+            'objects': len(instances),
+            'queried_us': queried_time / len(instances) * 1000000,
+            'prefetched_us': prefetched_time / len(instances) * 1000000,
+            }
+        print '%-16s %10s %14.1f %16.1f' % (name, len(instances), results[name]['queried_us'], results[name]['prefetched_us'])
+    return results
+
+def benchmark_history(scale, backend):
+    """
+    Measures saving and committing the test models, and reading them back as of a revision.
+    """
+    from versions.base import revision
+    from versions.tests.models import Artist, Album, Song, Lyrics, Venue
+
+    results = {}
+
+    # Saves per second, for a single revision containing every object.
+    started = time.time()
+    create_data(scale)
+    elapsed = time.time() - started
+    saves = sum([ x.objects.count() for x in (Artist, Album, Song, Lyrics, Venue) ])
+    results['create'] = {
+        'saves': saves,
+        'seconds': elapsed,
+        'saves_per_second': saves / elapsed,
+        }
+    first_revision = revision.latest_transactions['default']
+
+    # The latency of revisions that each edit one artist and one of its songs.
+    artists = list(Artist.objects.order_by('pk'))
+    timings = []
+    for artist in artists:
+        song = Song.objects.filter(album__artist=artist).order_by('pk')[0]
+        started = time.time()
+        with revision:
+            artist.name = '%s (edited)' % artist.name
+            artist.save()
+            song.seconds += 1
+            song.save()
+        timings.append(time.time() - started)
+    results['commit'] = summarize(timings)
+
+    # Iterating over every song as of the first revision.
+    started = time.time()
+    count = len(list(Song.objects.version(first_revision).all()))
+    elapsed = time.time() - started
+    results['version_iteration'] = {
+        'objects': count,
+        'seconds': elapsed,
+        'objects_per_second': count / elapsed,
+        }
+
+    # Following related managers from artists as of the first revision.
+    timings = []
+    for artist in Artist.objects.version(first_revision).order_by('pk'):
+        started = time.time()
+        for album in artist.albums.all():
+            list(album.songs.all())
+        timings.append(time.time() - started)
+    results['related_access'] = summarize(timings)
+
+    # Listing the history of every artist, in full and the latest page.
+    timings = []
+    page_timings = []
+    for artist in artists:
+        started = time.time()
+        list(Artist.objects.versions(artist))
+        timings.append(time.time() - started)
+        started = time.time()
+        Artist.objects.versions(artist)[:10]
+        page_timings.append(time.time() - started)
+    results['versions'] = summarize(timings)
+    results['versions_page'] = summarize(page_timings)
+
+    # Comparing every artist with its first version.
+    timings = []
+    for artist in artists:
+        started = time.time()
+        Artist.objects.diff(artist, first_revision)
+        timings.append(time.time() - started)
+    results['diff'] = summarize(timings)
+
+    print '%-20s %s' % ('saves/sec', '%.1f' % results['create']['saves_per_second'])
+    for name in ('commit', 'related_access', 'versions', 'versions_page', 'diff'):
+        print '%-20s mean %8.2fms  p95 %8.2fms' % (name, results[name]['mean_ms'], results[name]['p95_ms'])
+    print '%-20s %s' % ('version objects/sec', '%.1f' % results['version_iteration']['objects_per_second'])
+    return results
+
+# Benchmarks, along with the backends they are run with (or `None` when they do not depend on one).
+BENCHMARKS = {
+    'codecs': (benchmark_codecs, None),
+    'history': (benchmark_history, ('hg', 'database',)),
+    'snapshots': (benchmark_snapshots, None),
+    }
+
+def runbenchmarks(benchmark_names, scale, output=None, backends=None):
+    if not benchmark_names:
+        benchmark_names = sorted(BENCHMARKS.keys())
+    sys.path.insert(0, DIRNAME)
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'versions.tests.settings'
+
+    log = logging.getLogger('versions')
+    handler = logging.handlers.MemoryHandler(1000)
+    log.addHandler(handler)
+
+    import django
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from django.utils import simplejson
+    from versions.base import revision
+
+    report = {
+        'scale': scale,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'results': {},
+        }
+
+    setup_test_environment()
+    old_name = settings.DATABASE_NAME
+    repository_dir = tempfile.mkdtemp()
+    configs = settings.VERSIONS_REPOSITORIES['default']
+    try:
+        for benchmark_name in benchmark_names:
+            benchmark, benchmark_backends = BENCHMARKS[benchmark_name]
+            for backend in benchmark_backends and [ x for x in benchmark_backends if not backends or x in backends ] or [None]:
+                print '\n%s%s' % (benchmark_name, backend and ' (%s)' % backend or '')
+
+                # Give every benchmark a fresh database and repositories.
+                configs['backend'] = BACKENDS[backend or 'hg']
+                configs['local'] = os.path.join(repository_dir, benchmark_name, backend or 'default')
+                revision._repos.clear()
+                revision._state.reset()
+                connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                try:
+                    result = benchmark(scale, backend)
+                finally:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+                if backend:
+                    report['results'].setdefault(benchmark_name, {})[backend] = result
+                else:
+                    report['results'][benchmark_name] = result
+    finally:
+        shutil.rmtree(repository_dir, ignore_errors=True)
+        teardown_test_environment()
+
+    if output:
+        f = open(output, 'w')
+        try:
+            simplejson.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        print '\nWrote the results to %s' % output
+    return report
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-s', '--scale', type='int', default=int(os.environ.get('VERSIONS_BENCHMARK_SCALE', 100)),
+        help='The number of synthetic artists to create (defaults to $VERSIONS_BENCHMARK_SCALE, or 100).')
+    parser.add_option('-b', '--backend', action='append', dest='backends', choices=sorted(BACKENDS.keys()),
+        help='Only run the benchmarks with this backend (may be given more than once).')
+    parser.add_option('-o', '--output', default=None,
+        help='Write the results to this file as JSON.')
+    options, args = parser.parse_args()
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark `%s`, choose from: %s' % (name, ', '.join(sorted(BENCHMARKS.keys()))))
+    runbenchmarks(args, options.scale, options.output, options.backends)
@@ -22,6 +22,7 @@ setup(
         'versions',
         'versions.backends',
         'versions.backends.database',
+        'versions.backends.git',
         'versions.backends.hg',
         'versions.management',
         'versions.management.commands',
@@ -1,14 +1,155 @@
+from itertools import islice
+import threading
+
+from versions.exceptions import VersionDoesNotExist
+
 class BaseRepository(object):
-    def __init__(self, key, local=None, remote=None):
+    # Whether commits to this repository can be made from another thread, concurrently with
+    # commits to other repositories.
+    concurrent_commits = True
+
+    # The revision of a repository before anything was committed to it.
+    null_revision = None
+
+    def __init__(self, key, local=None, remote=None, options=None):
         self.key = key
         self.local = local
         self.remote = remote
+        # The full configuration of this repository from `VERSIONS_REPOSITORIES`.
+        self.options = options or {}
+        # The tip of the repository, along with the order of its changesets at that tip (and the key
+        # of each of them), extended with the changesets committed since whenever the tip moves.
+        self._changeset_order = None
+        self._changeset_order_lock = threading.Lock()
 
     def commit(self, items):
         raise NotImplementedError
 
-    def versions(self, item):
+    def begin_bulk(self):
+        """
+        Starts committing many changesets in a row (e.g. from a management command). Backends
+        may defer making the commits visible to readers until `end_bulk` is called.
+        """
+        pass
+
+    def end_bulk(self):
+        """
+        Makes every commit since `begin_bulk` visible to readers.
+        """
+        pass
+
+    def resolve(self, rev=None):
+        """
+        Returns the immutable id of the given revision (resolving symbolic revisions, and `None`
+        for the latest revision), or `None` if reads of the revision can not be cached.
+        """
+        return None
+
+    def versions(self, item, limit=None, offset=0, before=None, after=None, since=None, until=None, reverse=False):
+        """
+        Returns the versions of the item, newest first (or oldest first if `reverse` is set).
+        Only versions committed between the `after` and `before` revisions (exclusive), and
+        between the `since` and `until` dates (inclusive) are listed, skipping the first
+        `offset` of them and returning at most `limit`.
+        """
         raise NotImplementedError
 
+    def count(self, item, before=None, after=None, since=None, until=None):
+        """
+        Returns the number of versions of the item within the given bounds.
+        """
+        count = 0
+        for version in self.versions(item, before=before, after=after, since=since, until=until):
+            count += 1
+        return count
+
+    def changesets(self):
+        """
+        Returns the (revision, user, message, date, items) of every changeset in the repository,
+        oldest first, where `items` lists the items the changeset changed.
+        """
+        raise NotImplementedError
+
+    def changeset_ids(self, since=None):
+        """
+        Returns the (revision, changeset id, timestamp) of every changeset in the repository,
+        oldest first, or only of those committed after the revision `since` (the tip at the
+        time). The changeset id is the id of the logical changeset of a sharded repository that
+        the changeset is part of, or `None` if none was recorded.
+        """
+        raise NotImplementedError
+
+    def _changeset_keys(self):
+        tip = self.resolve()
+        self._changeset_order_lock.acquire()
+        try:
+            order = self._changeset_order
+            if order is None or order[0] != tip:
+                changesets = None
+                if order is not None:
+                    try:
+                        changesets = list(self.changeset_ids(since=order[0]))
+                        keys, index = order[1], order[2]
+                    except VersionDoesNotExist:
+                        # The repository was recreated since the order was cached.
+                        pass
+                if changesets is None:
+                    changesets, keys, index = self.changeset_ids(), [], {}
+                for rev, changeset_id, timestamp in changesets:
+                    # Changesets without a changeset id are ordered by the time they were committed.
+                    key = changeset_id or '%020.6f' % timestamp
+                    keys.append((key, rev,))
+                    index[rev] = key
+                # Changesets committed since the tip was resolved may already be listed.
+                order = (keys and keys[-1][1] or tip, keys, index,)
+                self._changeset_order = order
+            return order
+        finally:
+            self._changeset_order_lock.release()
+
+    def changeset_key(self, rev):
+        """
+        Returns the key that orders the logical changeset of the given revision among those of
+        the other shards of the repository.
+        """
+        rev = self.resolve(rev)
+        key = self._changeset_keys()[2].get(rev, None)
+        if key is None:
+            raise VersionDoesNotExist('Revision `%s` does not exist in %s' % (rev, self.local))
+        return key
+
+    def changeset_before(self, key):
+        """
+        Returns the revision of the latest changeset that is part of the logical changeset `key`,
+        or of one made before it, or the null revision if there is no such changeset.
+        """
+        for x, rev in reversed(self._changeset_keys()[1]):
+            if x <= key:
+                return rev
+        return self.null_revision
+
+    def _paginate(self, versions, limit=None, offset=0, since=None, until=None):
+        """
+        Applies the date bounds and pagination of `versions` to an iterable of versions.
+        """
+        if since is not None or until is not None:
+            versions = ( x for x in versions if (since is None or x.date >= since) and (until is None or x.date <= until) )
+        if limit is None:
+            return islice(versions, offset, None)
+        return islice(versions, offset, offset + limit)
+
     def version(self, item, rev=None):
         raise NotImplementedError
+
+    def version_many(self, items, rev=None):
+        """
+        Returns a dictionary mapping each item to its data at the given revision,
+        omitting any items that do not exist at that revision.
+        """
+        versions = {}
+        for item in items:
+            try:
+                versions[item] = self.version(item, rev=rev)
+            except VersionDoesNotExist:
+                pass
+        return versions
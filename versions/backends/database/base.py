@@ -1,39 +1,317 @@
 import logging
 import os
+import zlib
 
-from django.utils.encoding import force_unicode, smart_str
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Max
+from django.utils.encoding import smart_str
 from versions.backends.base import BaseRepository
 from versions.base import revision, Version
-from versions.exceptions import VersionDoesNotExist
-from versions.backends.database.models import Changeset, Revision
+from versions.exceptions import VersionDoesNotExist, VersionsException
+from versions.backends.database.models import Changeset, Head, Revision, Tip
+
+# Markers stored alongside each revision payload, describing how it was encoded.
+CODEC_RAW = 'raw'
+CODEC_ZLIB = 'zlib'
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+# The number of revisions written by each INSERT statement. SQLite limits a statement to 999
+# parameters, so with five columns per revision this must stay below 200 there.
+DEFAULT_INSERT_BATCH_SIZE = 100
+
+# The database engines that can not insert several rows with a single INSERT statement.
+SINGLE_ROW_INSERT_ENGINES = set(['oracle'])
+
+# The number of times the heads of new paths are inserted, when concurrent commits insert them first.
+HEAD_INSERT_ATTEMPTS = 3
+
+# The primary key of the single row of the tip table.
+TIP_PK = 1
 
 class Repository(BaseRepository):
+    # The maximum number of paths to look up in a single query.
+    QUERY_BATCH_SIZE = 500
+
+    # Revisions are written through the database connection (and transaction) of the committing thread.
+    concurrent_commits = False
+
+    # The latest changeset known to be committed. When commits are serialized, changesets are
+    # committed in the order of their ids, so the revisions up to it can never change.
+    _committed_tip = 0
+
+    def serialize_commits(self):
+        return self.options.get('serialize_commits', False)
+    serialize_commits = property(serialize_commits)
+
     def commit(self, changes):
+        if transaction.is_managed():
+            # The changeset is written as part of the caller's transaction.
+            return self._commit(changes)
+        changeset_pk = transaction.commit_on_success(self._commit)(changes)
+        if self.serialize_commits:
+            self._committed_tip = max(self._committed_tip, changeset_pk)
+        return changeset_pk
+
+    def _commit(self, changes):
         changeset = Changeset()
         changeset.message = revision.message
         changeset.user = revision.user.id
+        if self.serialize_commits:
+            # The tip stays locked until the transaction ends, so the parent is the latest committed changeset.
+            changeset.parent_changeset_id = self._lock_tip()
+        else:
+            # Without the lock, a concurrent commit may still commit a changeset between the parent and this one.
+            changeset.parent_changeset_id = Changeset.objects.aggregate(parent=Max('pk'))['parent']
         changeset.save()
+        if self.serialize_commits:
+            Tip.objects.filter(pk=TIP_PK).update(changeset=changeset.pk)
 
+        rows = []
         for path, data in changes.items():
-            rev = Revision()
-            rev.changeset = changeset
-            rev.path = path
-            rev.data = force_unicode(data, errors='ignore')
-            rev.save()
+            payload, codec = self.encode_payload(data)
+            rows.append((changeset.pk, path, '', payload, codec,))
+        self._insert_rows(Revision, ('changeset', 'path', 'data', 'payload', 'codec',), rows)
+        self._update_heads(changeset.pk, changes.keys())
 
         return changeset.pk
 
-    def versions(self, path):
-        return Changeset.objects.filter(revisions__path=path).order_by('-pk')
+    def _lock_tip(self):
+        """
+        Locks the tip until the current transaction ends, and returns the id of the latest changeset.
+        """
+        if not Tip.objects.filter(pk=TIP_PK).update(changeset=F('changeset')):
+            savepoint = transaction.savepoint()
+            try:
+                Tip.objects.create(pk=TIP_PK, changeset_id=Changeset.objects.aggregate(tip=Max('pk'))['tip'])
+            except IntegrityError:
+                # A concurrent commit recorded the tip first, wait for it instead.
+                transaction.savepoint_rollback(savepoint)
+                Tip.objects.filter(pk=TIP_PK).update(changeset=F('changeset'))
+            else:
+                transaction.savepoint_commit(savepoint)
+        # Changesets committed while commits were not serialized did not move the tip.
+        return Changeset.objects.aggregate(tip=Max('pk'))['tip']
+
+    def _update_heads(self, changeset_pk, paths):
+        """
+        Points the head of each of the paths at the given changeset, unless another commit
+        already pointed it at a later changeset.
+        """
+        for offset in xrange(0, len(paths), self.QUERY_BATCH_SIZE):
+            batch = paths[offset:offset + self.QUERY_BATCH_SIZE]
+            for attempt in xrange(HEAD_INSERT_ATTEMPTS):
+                # Only ever move heads forward, a changeset with a lower id can finish committing last.
+                Head.objects.filter(path__in=batch, changeset__lt=changeset_pk).update(changeset=changeset_pk)
+                existing_paths = set(Head.objects.filter(path__in=batch).values_list('path', flat=True))
+                missing_paths = [ x for x in batch if x not in existing_paths ]
+                if not missing_paths:
+                    break
+
+                savepoint = transaction.savepoint()
+                try:
+                    self._insert_rows(Head, ('path', 'changeset',), [ (x, changeset_pk,) for x in missing_paths ])
+                except IntegrityError:
+                    # A concurrent commit recorded the head of some of the paths first, update those instead.
+                    transaction.savepoint_rollback(savepoint)
+                    if attempt == HEAD_INSERT_ATTEMPTS - 1:
+                        raise
+                else:
+                    transaction.savepoint_commit(savepoint)
+                    break
+
+    def _insert_rows(self, model, field_names, rows):
+        """
+        Writes the given rows of values for the named fields with multi-row INSERTs, or with a
+        single-row INSERT executed for every row on databases without multi-row INSERTs.
+        """
+        qn = connection.ops.quote_name
+        fields = [ model._meta.get_field(x) for x in field_names ]
+        insert_sql = 'INSERT INTO %s (%s) VALUES ' % (qn(model._meta.db_table), ', '.join([ qn(x.column) for x in fields ]))
+        row_sql = '(%s)' % ', '.join([ '%s' ] * len(fields))
+
+        batch_size = self.options.get('insert_batch_size', DEFAULT_INSERT_BATCH_SIZE)
+        cursor = connection.cursor()
+        for offset in xrange(0, len(rows), batch_size):
+            batch = [ [ field.get_db_prep_save(value) for field, value in zip(fields, row) ] for row in rows[offset:offset + batch_size] ]
+            if not self.multi_row_inserts():
+                cursor.executemany(insert_sql + row_sql, batch)
+                continue
+            params = []
+            for row in batch:
+                params.extend(row)
+            cursor.execute(insert_sql + ', '.join([ row_sql ] * len(batch)), params)
+        transaction.commit_unless_managed()
+
+    def multi_row_inserts(self):
+        """
+        Returns whether the database can insert several rows with a single INSERT statement.
+        """
+        if settings.DATABASE_ENGINE in SINGLE_ROW_INSERT_ENGINES:
+            return False
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            # SQLite only supports multi-row VALUES since 3.7.11.
+            from django.db.backends.sqlite3.base import Database
+            return Database.sqlite_version_info >= (3, 7, 11)
+        return True
+
+    def encode_payload(self, data):
+        """
+        Returns the payload and codec marker used to store the given data, compressing it
+        whenever that makes it smaller.
+        """
+        level = self.options.get('compress_level', DEFAULT_COMPRESS_LEVEL)
+        if level:
+            compressed = zlib.compress(data, level)
+            if len(compressed) < len(data):
+                return compressed, CODEC_ZLIB
+        return data, CODEC_RAW
+
+    def decode_payload(self, data, payload, codec):
+        if payload is None:
+            # This revision was written before payloads were stored in binary.
+            return smart_str(data)
+        payload = str(payload)
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(payload)
+        elif codec == CODEC_RAW:
+            return payload
+        raise VersionsException('Unable to decode a revision payload stored with the unknown codec `%s`.' % codec)
+
+    def resolve(self, rev=None):
+        if rev is None or rev == 'tip':
+            # The latest revisions are read through the heads, without looking the tip up first.
+            return None
+        rev = int(rev)
+        if not self.serialize_commits:
+            # A changeset with a lower id can still be committed, and change what the revision reads.
+            return None
+        if rev > self._committed_tip:
+            self._committed_tip = self._tip()
+            if rev > self._committed_tip:
+                # Reads of changesets that were not committed yet could still change.
+                return None
+        return rev
+
+    def _tip(self):
+        # Changesets that are still being committed are not visible yet, and get a higher id than any
+        # committed one while commits are serialized.
+        return Changeset.objects.aggregate(tip=Max('pk'))['tip'] or 0
+
+    def _changeset_pk(self, rev):
+        """
+        Returns the id of the changeset of the given revision, like the other backends raising
+        `VersionDoesNotExist` for revisions that do not exist.
+        """
+        try:
+            pk = int(rev)
+        except (TypeError, ValueError):
+            pk = None
+        if pk is None or not Changeset.objects.filter(pk=pk).count():
+            raise VersionDoesNotExist('Revision `%s` does not exist' % rev)
+        return pk
+
+    def _changesets(self, path, limit=None, offset=0, before=None, after=None, since=None, until=None, reverse=False):
+        changesets = Changeset.objects.filter(revisions__path=path)
+        if before is not None:
+            changesets = changesets.filter(pk__lt=self._changeset_pk(before))
+        if after is not None:
+            changesets = changesets.filter(pk__gt=self._changeset_pk(after))
+        if since is not None:
+            changesets = changesets.filter(time_create__gte=since)
+        if until is not None:
+            changesets = changesets.filter(time_create__lte=until)
+        changesets = changesets.order_by(reverse and 'pk' or '-pk')
+        if limit is not None:
+            changesets = changesets[offset:offset + limit]
+        elif offset:
+            changesets = changesets[offset:]
+        return changesets
+
+    def versions(self, path, **kwargs):
+        return self._changesets(path, **kwargs).select_related('parent_changeset')
+
+    def count(self, path, **kwargs):
+        return self._changesets(path, **kwargs).count()
+
+    def history(self, path, **kwargs):
+        """
+        Returns a list describing the changesets of the path, newest first, as dictionaries of
+        its `revision`, the revision of its `parent`, and its `user`, `message` and `date`. Takes
+        the same arguments as `versions`.
+        """
+        history = []
+        for pk, parent, user, message, date in self._changesets(path, **kwargs).values_list('pk', 'parent_changeset', 'user', 'message', 'time_create'):
+            history.append({
+                'revision': str(pk),
+                'parent': parent is not None and str(parent) or None,
+                'user': user,
+                'message': message,
+                'date': date,
+                })
+        return history
+
+    def _head_revisions(self, paths):
+        """
+        Returns a queryset of the latest revisions of the given paths, found through their heads.
+        """
+        qn = connection.ops.quote_name
+        revision_table = qn(Revision._meta.db_table)
+        head_table = qn(Head._meta.db_table)
+        return Revision.objects.filter(path__in=paths).extra(tables=[Head._meta.db_table], where=[
+            '%s.%s = %s.%s' % (head_table, qn(Head._meta.get_field('path').column), revision_table, qn(Revision._meta.get_field('path').column)),
+            '%s.%s = %s.%s' % (head_table, qn(Head._meta.get_field('changeset').column), revision_table, qn(Revision._meta.get_field('changeset').column)),
+            ])
 
     def version(self, item, rev=None):
-        revision = Revision.objects.filter(path=item)
+        version = None
+        if rev is None or rev == 'tip':
+            try:
+                version = self._head_revisions([item]).get()
+            except Revision.DoesNotExist:
+                # Paths that were last written before heads were recorded do not have one yet.
+                pass
+
+        if version is None:
+            revision = Revision.objects.filter(path=item)
+            if rev is not None and rev != 'tip':
+                revision = revision.filter(changeset__pk__lte=rev)
+            revision = revision.order_by('-changeset')[:1]
+            try:
+                version = revision.get()
+            except Revision.DoesNotExist:
+                raise VersionDoesNotExist('Version `%s` does not exist for %s' % (rev, item))
+
+        return self.decode_payload(version.data, version.payload, version.codec)
+
+    def version_many(self, items, rev=None):
+        qn = connection.ops.quote_name
+        table = qn(Revision._meta.db_table)
+        path_column = qn(Revision._meta.get_field('path').column)
+        changeset_column = qn(Revision._meta.get_field('changeset').column)
+
+        # Only select the latest revision of each path, up to the requested changeset.
+        latest_sql = '%s.%s = (SELECT MAX(latest.%s) FROM %s latest WHERE latest.%s = %s.%s' % (table, changeset_column, changeset_column, table, path_column, table, path_column)
+        params = []
         if rev is not None and rev != 'tip':
-            revision = revision.filter(changeset__pk__lte=rev)
-        revision = revision.order_by('-changeset__pk')[:1]
-        try:
-            version = revision.get()
-        except Revision.DoesNotExist:
-            raise VersionDoesNotExist('Version `%s` does not exist for %s' % (rev, item))
+            latest_sql += ' AND latest.%s <= %%s' % changeset_column
+            params.append(rev)
+        latest_sql += ')'
+
+        items = list(items)
+        versions = {}
+        for offset in xrange(0, len(items), self.QUERY_BATCH_SIZE):
+            batch = items[offset:offset + self.QUERY_BATCH_SIZE]
+            if rev is None or rev == 'tip':
+                for path, data, payload, codec in self._head_revisions(batch).values_list('path', 'data', 'payload', 'codec'):
+                    versions[path] = self.decode_payload(data, payload, codec)
+                # Paths that were last written before heads were recorded do not have one yet.
+                batch = [ x for x in batch if x not in versions ]
+                if not batch:
+                    continue
 
-        return smart_str(version.data)
+            revisions = Revision.objects.filter(path__in=batch).extra(where=[latest_sql], params=params)
+            for path, data, payload, codec in revisions.values_list('path', 'data', 'payload', 'codec'):
+                versions[path] = self.decode_payload(data, payload, codec)
+        return versions
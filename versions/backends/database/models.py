@@ -1,11 +1,41 @@
+from django.conf import settings
 from django.db import models
 
+class BlobField(models.Field):
+    """
+    Stores raw binary data, which a TextField would have to decode as text.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def db_type(self):
+        return {
+            'mysql': 'longblob',
+            'oracle': 'BLOB',
+            'postgresql': 'bytea',
+            'postgresql_psycopg2': 'bytea',
+            }.get(settings.DATABASE_ENGINE, 'blob')
+
+    def to_python(self, value):
+        if isinstance(value, buffer):
+            return str(value)
+        return value
+
+    def get_db_prep_value(self, value):
+        if value is None or settings.DATABASE_ENGINE == 'mysql':
+            return value
+        return buffer(value)
+
 class Changeset(models.Model):
     user = models.CharField(max_length=32, null=True)
     message = models.TextField(blank=True)
     time_create = models.DateTimeField(auto_now=True)
+    parent_changeset = models.ForeignKey('self', null=True, related_name='children')
 
     def parent(self):
+        if self.parent_changeset_id is not None:
+            return self.parent_changeset
+
+        # The first changeset, and changesets written before parents were recorded, look their parent up.
         try:
             return Changeset.objects.filter(pk__lt=self.pk).order_by('-pk')[:1].get()
         except Changeset.DoesNotExist:
@@ -23,4 +53,26 @@ class Changeset(models.Model):
 class Revision(models.Model):
     changeset = models.ForeignKey(Changeset, related_name='revisions')
     path = models.CharField(max_length=255, db_index=True)
-    data = models.TextField()
+    # Revisions written before payloads were stored in binary keep their data in this column.
+    data = models.TextField(blank=True, default='')
+    payload = BlobField(null=True)
+    codec = models.CharField(max_length=8, blank=True, default='')
+
+    class Meta:
+        # Indexes (path, changeset) so that finding the revision of a path as of a changeset is a single index seek.
+        unique_together = (('path', 'changeset',),)
+
+class Tip(models.Model):
+    """
+    Points at the latest changeset. With the `serialize_commits` option, commits update its single
+    row before writing their changeset, which makes them wait for each other, so that changesets
+    are committed in the order of their ids.
+    """
+    changeset = models.ForeignKey(Changeset, null=True, related_name='tips')
+
+class Head(models.Model):
+    """
+    Points at the changeset holding the latest revision of each path.
+    """
+    path = models.CharField(max_length=255, unique=True)
+    changeset = models.ForeignKey(Changeset, related_name='heads')
@@ -1,6 +1,396 @@
+import fcntl
+import os
+import subprocess
+import threading
+import time
+
 from versions.backends.base import BaseRepository
-from versions.exceptions import VersionDoesNotExist
+from versions.exceptions import VersionDoesNotExist, VersionsException
 from versions.base import revision, Version
 
+# The branch that holds the history of the repository.
+BRANCH = 'refs/heads/master'
+
+NULL_ID = '0' * 40
+
+# The trailer of the commit messages recording the logical changeset a commit to a shard is part of.
+CHANGESET_TRAILER = 'Versions-Changeset: '
+
+# The number of commits made in bulk between checkpoints, each of which writes a packfile.
+BULK_CHECKPOINT_INTERVAL = 1000
+
+# The number of commits made by a repository between runs of `git gc --auto`, which packs the
+# loose objects and small packfiles left by checkpoints once there are enough of them.
+GC_INTERVAL = 1000
+
+# The number of objects requested from `git cat-file --batch` before reading the responses,
+# which keeps the requests well within the size of a pipe buffer.
+READ_BATCH_SIZE = 100
+
 class Repository(BaseRepository):
-    pass
+    """
+    Stores history in a local bare git repository. Commits are streamed through a long lived
+    `git fast-import` process, and history is read through a long lived `git cat-file --batch`
+    process, so neither commits nor reads spawn a process per item.
+    """
+    null_revision = NULL_ID
+
+    def __init__(self, *args, **kwargs):
+        super(Repository, self).__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+        self._fast_import = None
+        self._cat_file = None
+        self._mark = 0
+        # The lock on the repository held while committing in bulk, and the mark of the latest
+        # commit that was not checkpointed yet.
+        self._bulk_lock_file = None
+        self._bulk_mark = None
+        self._bulk_commits = 0
+        self._commits_since_gc = 0
+
+    def _git(self, *args):
+        process = subprocess.Popen(('git', '--git-dir=%s' % self.local,) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        if process.returncode != 0:
+            raise VersionsException('git %s failed in %s: %s' % (' '.join(args), self.local, errors.strip()))
+        return output
+
+    def _ensure_repository(self):
+        if not os.path.exists(os.path.join(self.local, 'objects')):
+            # The repository was removed (or never created), any running processes point at stale data.
+            self.close()
+            if not os.path.exists(self.local):
+                os.makedirs(self.local)
+            self._git('init', '--bare', '--quiet')
+
+    def _process(self, name, *args):
+        self._ensure_repository()
+        process = getattr(self, name)
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(('git', '--git-dir=%s' % self.local,) + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            setattr(self, name, process)
+        return process
+
+    def close(self):
+        """
+        Stops the long lived git processes used by this repository.
+        """
+        self._lock.acquire()
+        try:
+            if self._fast_import is not None:
+                if self._fast_import.poll() is None:
+                    self._fast_import.stdin.write('done\n')
+                    self._fast_import.stdin.close()
+                self._fast_import.wait()
+                self._fast_import = None
+            if self._cat_file is not None:
+                if self._cat_file.poll() is None:
+                    self._cat_file.stdin.close()
+                self._cat_file.wait()
+                self._cat_file = None
+        finally:
+            self._lock.release()
+
+    def _read_objects(self, names):
+        """
+        Reads each of the named objects through `git cat-file --batch`, returning a list of
+        (sha, type, data) tuples, or `None` for every object that does not exist.
+        """
+        results = []
+        self._lock.acquire()
+        try:
+            process = self._process('_cat_file', 'cat-file', '--batch')
+            for offset in xrange(0, len(names), READ_BATCH_SIZE):
+                batch = names[offset:offset + READ_BATCH_SIZE]
+                try:
+                    process.stdin.write(''.join([ '%s\n' % x for x in batch ]))
+                    process.stdin.flush()
+                    for name in batch:
+                        header = process.stdout.readline()
+                        if not header:
+                            raise VersionsException('git cat-file exited unexpectedly in %s: %s' % (self.local, process.stderr.read().strip()))
+                        parts = header.split()
+                        if len(parts) != 3:
+                            # The object is either missing or ambiguous.
+                            results.append(None)
+                            continue
+                        sha, object_type, size = parts
+                        data = process.stdout.read(int(size))
+                        process.stdout.read(1)
+                        results.append((sha, object_type, data,))
+                except (IOError, OSError):
+                    self._cat_file = None
+                    raise
+        finally:
+            self._lock.release()
+        return results
+
+    def _lock_repository(self):
+        lock_file = open(os.path.join(self.local, 'versions.lock'), 'w')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def begin_bulk(self):
+        """
+        Commits made until `end_bulk` are only checkpointed every `BULK_CHECKPOINT_INTERVAL`
+        commits, so that they are written to a few large packfiles. The repository stays locked
+        against commits by other processes, and readers do not see the commits until they are
+        checkpointed.
+        """
+        self._lock.acquire()
+        try:
+            if self._bulk_lock_file is None:
+                self._ensure_repository()
+                self._bulk_lock_file = self._lock_repository()
+                self._bulk_commits = 0
+        finally:
+            self._lock.release()
+
+    def end_bulk(self):
+        self._lock.acquire()
+        try:
+            if self._bulk_lock_file is None:
+                return
+            try:
+                self._checkpoint()
+                self._gc()
+            finally:
+                fcntl.flock(self._bulk_lock_file.fileno(), fcntl.LOCK_UN)
+                self._bulk_lock_file.close()
+                self._bulk_lock_file = None
+        finally:
+            self._lock.release()
+
+    def _checkpoint(self):
+        if self._bulk_mark is None:
+            return
+        process = self._process('_fast_import', 'fast-import', '--quiet', '--done')
+        # Asking for a mark once the checkpoint was requested waits for it to finish.
+        self._fast_import_command(process, 'checkpoint\nget-mark :%s\n' % self._bulk_mark)
+        self._bulk_mark = None
+
+    def _fast_import_command(self, process, command):
+        """
+        Sends the command to `git fast-import`, returning the line it responds with.
+        """
+        try:
+            process.stdin.write(command)
+            process.stdin.flush()
+            response = process.stdout.readline().strip()
+        except (IOError, OSError):
+            response = ''
+        if not response:
+            process.wait()
+            self._fast_import = None
+            self._bulk_mark = None
+            raise VersionsException('git fast-import failed in %s: %s' % (self.local, process.stderr.read().strip()))
+        return response
+
+    def _gc(self):
+        self._commits_since_gc = 0
+        self._git('gc', '--auto', '--quiet')
+
+    def commit(self, items):
+        user = str(revision.user.id)
+        message = revision.message
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        if revision.changeset_id:
+            message = '%s\n\n%s%s' % (message, CHANGESET_TRAILER, revision.changeset_id)
+
+        self._lock.acquire()
+        try:
+            process = self._process('_fast_import', 'fast-import', '--quiet', '--done')
+            lock_file = self._bulk_lock_file or self._lock_repository()
+            try:
+                self._mark += 1
+                mark = self._mark
+                if self._bulk_mark is not None:
+                    parent = ':%s' % self._bulk_mark
+                else:
+                    parent = self.resolve()
+
+                commands = [
+                    'commit %s\n' % BRANCH,
+                    'mark :%s\n' % mark,
+                    'committer %s <> %s +0000\n' % (user, int(time.time())),
+                    'data %s\n%s\n' % (len(message), message),
+                    ]
+                if parent != NULL_ID:
+                    commands.append('from %s\n' % parent)
+                for path, data in items.items():
+                    commands.append('M 100644 inline %s\ndata %s\n%s\n' % (path, len(data), data))
+                if self._bulk_lock_file is None:
+                    # Make the commit visible to readers, then ask for its id.
+                    commands.append('\ncheckpoint\nget-mark :%s\n' % mark)
+                else:
+                    commands.append('\nget-mark :%s\n' % mark)
+                version = self._fast_import_command(process, ''.join(commands))
+
+                if self._bulk_lock_file is None:
+                    self._commits_since_gc += 1
+                    if self._commits_since_gc >= GC_INTERVAL:
+                        self._gc()
+                else:
+                    self._bulk_mark = mark
+                    self._bulk_commits += 1
+                    if self._bulk_commits % BULK_CHECKPOINT_INTERVAL == 0:
+                        self._checkpoint()
+                return version
+            finally:
+                if lock_file is not self._bulk_lock_file:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                    lock_file.close()
+        finally:
+            self._lock.release()
+
+    def resolve(self, rev=None):
+        if rev is None or rev == 'tip':
+            rev = BRANCH
+        elif rev == NULL_ID:
+            # The revision of an empty repository, e.g. a shard nothing was committed to yet.
+            return NULL_ID
+        result = self._read_objects(['%s^{commit}' % rev])[0]
+        if result is None:
+            if rev == BRANCH:
+                # Nothing has been committed to this repository yet.
+                return NULL_ID
+            raise VersionDoesNotExist('Revision `%s` does not exist in %s' % (rev, self.local))
+        return result[0]
+
+    def versions(self, item, limit=None, offset=0, before=None, after=None, since=None, until=None, reverse=False):
+        return self._paginate(self._log(item, limit, offset, before, after, since, until, reverse), limit, offset, since, until)
+
+    def _log(self, item, limit=None, offset=0, before=None, after=None, since=None, until=None, reverse=False):
+        start = self.resolve(before)
+        if start == NULL_ID:
+            return
+        args = ['log', '--format=%H%x1f%P%x1f%cn%x1f%cd%x1f%B%x1e', '--date=raw']
+        if limit is not None and not reverse and since is None and until is None:
+            # git applies the limit before reversing the log, so oldest first listings are paginated afterwards.
+            args.append('-n%s' % (offset + limit + (before is not None and 1 or 0)))
+        if reverse:
+            args.append('--reverse')
+        args.append(start)
+        if after is not None:
+            args.append('^%s' % self.resolve(after))
+        output = self._git(*(args + ['--', item]))
+
+        for entry in output.split('\x1e'):
+            entry = entry.strip('\n')
+            if not entry:
+                continue
+            sha, parents, user, date, message = entry.split('\x1f')
+            if before is not None and sha == start:
+                continue
+            yield Version(Commit(self, sha, parents.split(), user, _parse_date(date), message))
+
+    def changesets(self):
+        tip = self.resolve()
+        if tip == NULL_ID:
+            return
+        output = self._git('log', '--reverse', '--name-only', '--format=%x1e%H%x1f%cn%x1f%cd%x1f%B%x1f', '--date=raw', tip)
+        for entry in output.split('\x1e'):
+            if not entry.strip():
+                continue
+            sha, user, date, message, items = entry.split('\x1f')
+            commit = Commit(self, sha, [], user, _parse_date(date), message)
+            yield sha, user, commit.description(), Version(commit).date, [ x for x in items.split('\n') if x ]
+
+    def changeset_ids(self, since=None):
+        tip = self.resolve()
+        if tip == NULL_ID:
+            return
+        if since is not None and self.resolve(since) != NULL_ID:
+            tip = '%s..%s' % (since, tip)
+        output = self._git('log', '--reverse', '--format=%H%x1f%ct%x1f%B%x1e', tip)
+        for entry in output.split('\x1e'):
+            entry = entry.strip('\n')
+            if not entry:
+                continue
+            sha, timestamp, message = entry.split('\x1f')
+            yield sha, _split_changeset_id(message)[1], int(timestamp)
+
+    def version(self, item, rev=None):
+        result = self.version_many([item], rev=rev)
+        if item not in result:
+            raise VersionDoesNotExist('Version `%s` does not exist for %s in %s' % (rev, item, self.local))
+        return result[item]
+
+    def version_many(self, items, rev=None):
+        items = list(items)
+        tip = self.resolve(rev)
+        versions = {}
+        if tip == NULL_ID:
+            return versions
+        for item, result in zip(items, self._read_objects([ '%s:%s' % (tip, x) for x in items ])):
+            if result is not None and result[1] == 'blob':
+                versions[item] = result[2]
+        return versions
+
+    def _commit_details(self, sha):
+        result = self._read_objects([sha])[0]
+        if result is None:
+            raise VersionDoesNotExist('Revision `%s` does not exist in %s' % (sha, self.local))
+        headers, message = result[2].split('\n\n', 1)
+        parents = []
+        user, date = None, (0, 0)
+        for line in headers.split('\n'):
+            key, value = line.split(' ', 1)
+            if key == 'parent':
+                parents.append(value)
+            elif key == 'committer':
+                user, when = value.rsplit(' <', 1)
+                date = _parse_date(when.split('> ', 1)[1])
+        return parents, user, date, message
+
+class Commit(object):
+    """
+    Exposes a git commit through the interface `versions.base.Version` expects from a Mercurial changectx.
+    """
+    def __init__(self, repository, sha, parents=None, user=None, date=None, message=None):
+        self._repository = repository
+        self._sha = sha
+        self._details = None
+        if parents is not None:
+            self._details = (parents, user, date, message,)
+
+    def _load(self):
+        if self._details is None:
+            self._details = self._repository._commit_details(self._sha)
+        return self._details
+
+    def hex(self):
+        return self._sha
+
+    def parents(self):
+        return [ Commit(self._repository, x) for x in self._load()[0] ]
+
+    def user(self):
+        return self._load()[1]
+
+    def date(self):
+        return self._load()[2]
+
+    def description(self):
+        return _split_changeset_id(self._load()[3])[0]
+
+def _split_changeset_id(message):
+    """
+    Splits a commit message into the message itself and the changeset id recorded in it, if any.
+    """
+    message = message.rstrip('\n')
+    lines = message.split('\n')
+    if lines[-1].startswith(CHANGESET_TRAILER):
+        return '\n'.join(lines[:-1]).rstrip('\n'), lines[-1][len(CHANGESET_TRAILER):]
+    return message, None
+
+def _parse_date(value):
+    """
+    Converts a raw git date (`1275324360 +0200`) to a Mercurial style (timestamp, offset) tuple.
+    """
+    timestamp, offset = value.split()
+    seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    if offset[0] == '+':
+        seconds = -seconds
+    return int(timestamp), seconds
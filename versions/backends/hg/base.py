@@ -1,42 +1,309 @@
 import logging
 import os
+import threading
+import time
 
-from mercurial.cmdutil import walkchangerevs
 from mercurial import context
 from mercurial import error
 from mercurial import hg
-from mercurial import match
 from mercurial import node
 from mercurial import ui
+try:
+    from mercurial import parser, revset
+except ImportError:
+    # Mercurial releases before 1.6 do not have revsets.
+    revset = None
+try:
+    from mercurial import fileset
+except ImportError:
+    # Mercurial releases before 1.9 do not have filesets.
+    fileset = None
 
+from versions import stats
 from versions.backends.base import BaseRepository
 from versions.exceptions import VersionDoesNotExist
 from versions.base import revision, Version
 
+# The number of idle handles kept open for each repository.
+DEFAULT_POOL_SIZE = 4
+
+# The key of the changeset extra recording the logical changeset a commit to a shard is part of.
+CHANGESET_EXTRA = 'versions_changeset'
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _parse_per_call(module):
+    """
+    Mercurial parses revsets and filesets with a single parser per module, which keeps the state
+    of the expression being parsed (`parser.parser._iter` and `current`). Commits evaluate revsets
+    (e.g. `phases.retractboundary`), so commits made by several threads at once could read each
+    other's tokens. Every expression is parsed with a parser of its own instead.
+    """
+    shared = getattr(getattr(module, 'parse', None), 'im_self', None)
+    if isinstance(shared, parser.parser):
+        def parse(spec):
+            return parser.parser(shared._tokenizer, shared._elements, shared._methods).parse(spec)
+        module.parse = parse
+
+for module in (revset, fileset,):
+    if module is not None:
+        _parse_per_call(module)
+
+class RepositoryHandle(object):
+    """
+    An open Mercurial repository, leased from a `HandlePool` by one thread at a time.
+    """
+    def __init__(self, pool, repo):
+        self.pool = pool
+        self.repo = repo
+        self._signature = self._stat()
+
+    def _stat(self):
+        signature = []
+        for name in ('requires', os.path.join('store', '00changelog.i')):
+            try:
+                stat = os.stat(os.path.join(self.repo.path, name))
+            except OSError:
+                signature.append(None)
+            else:
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime,))
+        return tuple(signature)
+
+    def refresh(self):
+        """
+        Makes sure the handle sees changesets committed since it was last used, returning
+        False when the repository was removed or recreated and the handle can not be reused.
+        """
+        signature = self._stat()
+        if signature[0] is None or signature[0] != self._signature[0]:
+            return False
+        if signature[1] != self._signature[1]:
+            self.repo.invalidate()
+            self._signature = signature
+        return True
+
+    def mark_current(self):
+        """
+        Records that the handle has seen the current changelog, e.g. after committing to it.
+        """
+        self._signature = self._stat()
+
+    def release(self):
+        self.pool.release(self)
+
+class HandlePool(object):
+    """
+    Keeps Mercurial repository handles open between revisions, so that every revision does not
+    have to open the repository and read its changelog again. Only `size` idle handles are kept.
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def _pop(self):
+        self._lock.acquire()
+        try:
+            if self._handles:
+                return self._handles.pop()
+        finally:
+            self._lock.release()
+
+    def acquire(self, ui, path):
+        handle = self._pop()
+        while handle is not None and not handle.refresh():
+            handle = self._pop()
+        if handle is None:
+            handle = RepositoryHandle(self, hg.repository(ui, path))
+        return handle
+
+    def release(self, handle):
+        self._lock.acquire()
+        try:
+            if len(self._handles) < self.size and handle not in self._handles:
+                self._handles.append(handle)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._handles = []
+        finally:
+            self._lock.release()
+
 class Repository(BaseRepository):
+    null_revision = node.hex(node.nullid)
+
     def __init__(self, *args, **kwargs):
         self._ui = LogUI()
         self._ui.setconfig('ui', 'interactive', 'off')
         super(Repository, self).__init__(*args, **kwargs)
+        # The commits made through this repository that were not pushed to the remote yet.
+        self._unpushed = 0
+        self._unpushed_since = None
+        # Pushes the held back commits once `push_interval` has passed, if no commit does so first.
+        self._push_timer = None
 
     @property
-    def _local_repo(self):
+    def _pool(self):
+        path = os.path.abspath(self.local)
+        _pools_lock.acquire()
+        try:
+            if path not in _pools:
+                _pools[path] = HandlePool(self.options.get('pool_size', DEFAULT_POOL_SIZE))
+            return _pools[path]
+        finally:
+            _pools_lock.release()
+
+    @property
+    def _handle(self):
+        # The handle stays leased to this thread until its revision state is reset.
         if self.key not in revision._state.repositories:
             if not os.path.exists(self.local):
                 try:
                     os.makedirs(self.local)
-                    revision._state.repositories[self.key] = hg.repository(self._ui, self.local, create=True)
+                    hg.repository(self._ui, self.local, create=True)
                 except error.RepoError:
                     pass
-            if self.key not in revision._state.repositories:
-                revision._state.repositories[self.key] = hg.repository(self._ui, self.local)
+            revision._state.repositories[self.key] = self._pool.acquire(self._ui, self.local)
         return revision._state.repositories[self.key]
 
+    @property
+    def _local_repo(self):
+        return self._handle.repo
+
     @property
     def _remote_repo(self):
         if self.remote:
+            if hasattr(hg, 'peer'):
+                return hg.peer(self._ui, {}, self.remote)
+            # Mercurial releases before 2.3 open remote repositories like local ones.
             return hg.repository(self._ui, self.remote)
 
+    def _lock(self, local_repo):
+        started = time.time()
+        lock = local_repo.lock()
+        stats.timing('hg.lock_wait', time.time() - started)
+        return lock
+
+    def _pull(self, local_repo, remote_repo):
+        # Looking up the tip of the remote is much cheaper than pulling, which compares the histories.
+        if remote_repo.lookup('tip') not in local_repo.changelog.nodemap:
+            local_tip = local_repo['tip'].node()
+            local_repo.pull(remote_repo)
+            # Commits held back while another writer pushed are left on a head of their own, which
+            # later commits (made on top of the tip) would no longer see, and could not be pushed.
+            if self._unpushed and local_tip in local_repo.heads() and local_tip != local_repo['tip'].node():
+                self._merge(local_repo, local_repo['tip'], local_repo[local_tip])
+
+    def _merge(self, local_repo, remote_ctx, local_ctx):
+        """
+        Commits the merge of the held back commits up to `local_ctx` with the pulled `remote_ctx`,
+        keeping whichever version of each item was committed last.
+        """
+        ancestor_manifest = remote_ctx.ancestor(local_ctx).manifest()
+        remote_manifest = remote_ctx.manifest()
+        local_manifest = local_ctx.manifest()
+        items = {}
+        for path, file_node in local_manifest.items():
+            if file_node == ancestor_manifest.get(path, None) or file_node == remote_manifest.get(path, None):
+                continue
+            if remote_manifest.get(path, None) != ancestor_manifest.get(path, None) and remote_ctx[path].date()[0] > local_ctx[path].date()[0]:
+                continue
+            items[path] = local_ctx[path].data()
+
+        def file_callback(repo, memctx, path):
+            return context.memfilectx(
+                path=path,
+                data=items[path],
+                islink=False,
+                isexec=False,
+                copied=False,
+                )
+        ctx = context.memctx(
+            repo=local_repo,
+            parents=(remote_ctx.node(), local_ctx.node()),
+            text='Merge held back commits',
+            files=items.keys(),
+            filectxfn=file_callback,
+            user=local_ctx.user(),
+            )
+        local_repo.commitctx(ctx)
+        self._unpushed += 1
+        stats.incr('hg.merges')
+
+    def _push(self, local_repo, remote_repo):
+        local_repo.push(remote_repo)
+        stats.incr('hg.pushed_commits', self._unpushed)
+        if self._unpushed_since is not None:
+            stats.timing('hg.sync_lag', time.time() - self._unpushed_since)
+        self._unpushed = 0
+        self._unpushed_since = None
+        if self._push_timer is not None:
+            self._push_timer.cancel()
+            self._push_timer = None
+
+    def _should_push(self):
+        if self._unpushed >= self.options.get('push_commits', 1):
+            return True
+        interval = self.options.get('push_interval', None)
+        return interval is not None and time.time() - self._unpushed_since >= interval
+
+    def _schedule_push(self):
+        interval = self.options.get('push_interval', None)
+        if interval is None or self._push_timer is not None:
+            return
+        delay = max(interval - (time.time() - self._unpushed_since), 0)
+        self._push_timer = threading.Timer(delay, self._flush)
+        self._push_timer.setDaemon(True)
+        self._push_timer.start()
+
+    def _flush(self):
+        try:
+            try:
+                if self._unpushed:
+                    self.sync()
+            except Exception:
+                logging.getLogger('versions').exception('Pushing the held back commits of `%s` failed' % self.key)
+        finally:
+            if self._push_timer is threading.currentThread():
+                self._push_timer = None
+            # Return the handle the timer thread leased.
+            revision._state.reset()
+
+    def sync(self):
+        """
+        Pulls any changes from the remote, and pushes the commits that were held back.
+        """
+        remote_repo = self._remote_repo
+        if not remote_repo:
+            return
+        handle = self._handle
+        local_repo = handle.repo
+        lock = self._lock(local_repo)
+        try:
+            self._pull(local_repo, remote_repo)
+            if self._unpushed:
+                self._push(local_repo, remote_repo)
+            handle.mark_current()
+        finally:
+            lock.release()
+
+    def sync_lag(self):
+        """
+        Returns the number of commits that were not pushed to the remote yet, and how long ago
+        (in seconds) the oldest of them was made.
+        """
+        seconds = 0
+        if self._unpushed_since is not None:
+            seconds = time.time() - self._unpushed_since
+        return {
+            'commits': self._unpushed,
+            'seconds': seconds,
+            }
+
     def commit(self, items):
         def file_callback(repo, memctx, path):
             return context.memfilectx(
@@ -46,13 +313,15 @@ class Repository(BaseRepository):
                 isexec=False,
                 copied=False,
                 )
-        local_repo = self._local_repo
+        handle = self._handle
+        local_repo = handle.repo
         remote_repo = self._remote_repo
 
-        lock = local_repo.lock()
+        # Taking the lock reloads any changes other processes made to the repository.
+        lock = self._lock(local_repo)
         try:
             if remote_repo:
-                local_repo.pull(self._remote_repo)
+                self._pull(local_repo, remote_repo)
 
             ctx = context.memctx(
                 repo=local_repo,
@@ -61,23 +330,82 @@ class Repository(BaseRepository):
                 files=items.keys(),
                 filectxfn=file_callback,
                 user=str(revision.user.id),
+                extra=revision.changeset_id and { CHANGESET_EXTRA: revision.changeset_id } or None,
                 )
             version = node.hex(local_repo.commitctx(ctx))
             # TODO: if we want the working copy of the repository to be updated as well add logic to enable this.
             # hg.update(local_repo, local_repo['tip'].node())
             if remote_repo:
-                local_repo.push(remote_repo)
+                self._unpushed += 1
+                if self._unpushed_since is None:
+                    self._unpushed_since = time.time()
+                # Pushes can be held back until enough commits were made or enough time has passed.
+                if self._should_push():
+                    self._push(local_repo, remote_repo)
+                else:
+                    stats.incr('hg.held_back_commits')
+                    self._schedule_push()
 
+            handle.mark_current()
             return version
         finally:
             lock.release()
 
-    def versions(self, item):
+    def resolve(self, rev=None):
+        if rev is None:
+            rev = 'tip'
+        try:
+            return self._local_repo[rev].hex()
+        except error.RepoError:
+            raise VersionDoesNotExist('Revision `%s` does not exist in %s' % (rev, self.local))
+
+    def _link_revs(self, item, before=None, after=None, reverse=False):
+        # The filelog of the item links each of its revisions to the changeset that introduced it,
+        # so the history of an item is listed without walking the rest of the changelog.
+        local_repo = self._local_repo
+        filelog = local_repo.file(item)
+        if before is not None:
+            before = local_repo[self.resolve(before)].rev()
+        if after is not None:
+            after = local_repo[self.resolve(after)].rev()
+
+        if reverse:
+            file_revs = xrange(len(filelog))
+        else:
+            file_revs = xrange(len(filelog) - 1, -1, -1)
+        for file_rev in file_revs:
+            link_rev = filelog.linkrev(file_rev)
+            if (before is None or link_rev < before) and (after is None or link_rev > after):
+                yield link_rev
+
+    def versions(self, item, limit=None, offset=0, before=None, after=None, since=None, until=None, reverse=False):
+        local_repo = self._local_repo
+        versions = ( Version(local_repo[x]) for x in self._link_revs(item, before, after, reverse) )
+        return self._paginate(versions, limit, offset, since, until)
+
+    def count(self, item, before=None, after=None, since=None, until=None):
+        if since is not None or until is not None:
+            return super(Repository, self).count(item, before=before, after=after, since=since, until=until)
+        count = 0
+        for link_rev in self._link_revs(item, before, after):
+            count += 1
+        return count
+
+    def changesets(self):
         local_repo = self._local_repo
-        instance_match = match.exact(local_repo.root, local_repo.getcwd(), [item])
-        change_contexts = walkchangerevs(local_repo, instance_match, {'rev': None}, lambda ctx, fns: ctx)
-        for change_context in change_contexts:
-            yield Version(change_context)
+        for rev in local_repo:
+            ctx = local_repo[rev]
+            yield ctx.hex(), ctx.user(), ctx.description(), Version(ctx).date, ctx.files()
+
+    def changeset_ids(self, since=None):
+        local_repo = self._local_repo
+        start = 0
+        if since is not None:
+            # Changesets are only ever appended, so those committed since have higher revision numbers.
+            start = local_repo[self.resolve(since)].rev() + 1
+        for rev in xrange(start, len(local_repo)):
+            ctx = local_repo[rev]
+            yield ctx.hex(), ctx.extra().get(CHANGESET_EXTRA, None), ctx.date()[0]
 
     def version(self, item, rev=None):
         if rev is None:
@@ -91,9 +419,24 @@ class Repository(BaseRepository):
             raise VersionDoesNotExist('Version `%s` does not exist for %s in %s' % (rev, item, self.local))
         return raw_data
 
+    def version_many(self, items, rev=None):
+        if rev is None:
+            rev = 'tip'
+
+        # Resolve the changeset and its manifest once, and read every item's filelog from it.
+        local_repo = self._local_repo
+        manifest = local_repo[rev].manifest()
+        versions = {}
+        for item in items:
+            file_node = manifest.get(item, None)
+            if file_node is not None:
+                versions[item] = local_repo.file(item).read(file_node)
+        return versions
+
 class LogUI(ui.ui):
     def __init__(self, *args, **kwargs):
-        self.log = logging.getLogger('versions')
+        # Not named `log`, which would hide `ui.log` (used by hooks, e.g. when pushing).
+        self.logger = logging.getLogger('versions')
         super(LogUI, self).__init__(*args, **kwargs)
 
     def write(self, *args, **opts):
@@ -101,11 +444,11 @@ class LogUI(ui.ui):
             self._buffers[-1].extend([str(a) for a in args])
         else:
             for a in args:
-                self.log.info(str(a))
+                self.logger.info(str(a))
 
     def write_err(self, *args, **opts):
         for a in args:
-            self.log.error(str(a))
+            self.logger.error(str(a))
 
     def flush(self):
         pass
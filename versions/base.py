@@ -1,15 +1,14 @@
+from __future__ import with_statement
+
 from collections import defaultdict
 import datetime
 import difflib
 import logging
 import os
+import sys
 import threading
 import time
-
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import uuid
 
 try:
     from functools import wraps
@@ -19,10 +18,17 @@ except ImportError:
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, models
 from django.db.models.fields import related
+from django.utils.hashcompat import md5_constructor
 
-from versions.exceptions import VersionDoesNotExist, VersionsMultipleParents, VersionsManagementException
+from versions.exceptions import VersionDoesNotExist, VersionsCommitError, VersionsMultipleParents, VersionsManagementException
+from versions import codec
 from versions import signals
+from versions import stats
+from versions.cache import snapshot_cache
+from versions.pool import commit_pool
+from versions.spool import CommitSpool
 from versions.utils import load_backend
 
 __all__ = ('revision',)
@@ -34,30 +40,41 @@ elif not isinstance(settings.VERSIONS_REPOSITORIES, dict):
 elif not 'default' in settings.VERSIONS_REPOSITORIES:
     raise ImproperlyConfigured("You must always configure a `default` repository in `VERSIONS_REPOSITORIES`")
 
+# The number of primary keys queried at once when collecting the related ids of staged objects,
+# kept below the limit of query parameters of SQLite.
+RELATED_QUERY_CHUNK_SIZE = 500
+
 class RevisionState(threading.local):
     def __init__(self):
         self.reset()
 
     def reset(self):
+        # Return the repository handles this thread leased, so they can be reused by later revisions.
+        for handle in getattr(self, 'repositories', {}).values():
+            handle.release()
         self.repositories = {}
         self.staged_objects = defaultdict(dict)
         self.pending_objects = set([])
         self.pending_related_updates = defaultdict(dict)
-        self.cache = {}
+        self.prefetched_related = {}
         self.user = None
         self.message = ""
+        self.changeset_id = None
         self.depth = 0
         self.is_invalid = False
         self.is_finishing = False
         self.debug = False
         self.latest_transactions = {}
+        self.latest_skipped = {}
 
 class RevisionManager(object):
-    __slots__ = ("__weakref__", "_repos", "_state",)
+    __slots__ = ("__weakref__", "_repos", "_state", "_spools", "_spools_lock",)
 
     def __init__(self):
         self._state = RevisionState()
         self._repos = {}
+        self._spools = {}
+        self._spools_lock = threading.Lock()
 
     def is_active(self):
         return bool(self._state.depth > 0) or self._state.is_finishing
@@ -71,6 +88,10 @@ class RevisionManager(object):
         return self._state.latest_transactions
     latest_transactions = property(latest_transactions)
 
+    def latest_skipped(self):
+        return self._state.latest_skipped
+    latest_skipped = property(latest_skipped)
+
     def start(self, reset=False):
         if reset or self._state.depth == 0:
             self._state.reset()
@@ -89,19 +110,172 @@ class RevisionManager(object):
         # Handle end of revision conditions here.
         if self._state.depth == 0:
             transactions = {}
+            skipped = {}
             self._state.is_finishing = True
             try:
                 if not self.is_invalid() and (self._state.pending_objects or self._state.staged_objects):
+                    self.prefetch_related(self._state.pending_objects)
                     while self._state.pending_objects:
                         item = self._state.pending_objects.pop()
                         self.stage(item)
 
+                    # The commits to the shards of a repository all record the same changeset id,
+                    # which relates the revisions of the shards to each other.
+                    if [ x for x in self._state.staged_objects if self.shard(x)[1] is not None ]:
+                        self._state.changeset_id = new_changeset_id()
+
+                    commits = []
                     for repo, items in self._state.staged_objects.items():
-                        transactions[repo] = self[repo].commit(items)
+                        if self.configs(repo).get('async', False):
+                            self.spool(repo).put(items, self.user, self.message, self.changeset_id)
+                            continue
+                        if self.configs(repo).get('skip_unchanged', False):
+                            count = len(items)
+                            items = self._drop_unchanged(repo, items)
+                            if count > len(items):
+                                skipped[repo] = count - len(items)
+                                stats.incr('revision.skipped_items', count - len(items))
+                            if not items:
+                                continue
+                        commits.append((repo, items,))
+                    errors = self._commit_all(commits, transactions)
+
+                    # Remember what was committed, so that saving it again unchanged is skipped
+                    # without reading it back from the backend.
+                    for repo, items in commits:
+                        if repo in transactions and self.configs(repo).get('skip_unchanged', False):
+                            resolved_rev = self[repo].resolve(transactions[repo])
+                            if resolved_rev is not None:
+                                for item, data in items.items():
+                                    snapshot_cache.set((repo, item, resolved_rev,), data)
+
+                    # The commits to the shards of a repository form a single logical changeset,
+                    # identified by the revisions of all of its shards joined with `+`. There is
+                    # no such changeset when the commit to any of the shards failed.
+                    for key, configs in settings.VERSIONS_REPOSITORIES.items():
+                        shard_keys = self.shard_keys(key)
+                        if configs.get('shards', None) and [ x for x in shard_keys if x in transactions ] and not [ x for x in shard_keys if x in errors ]:
+                            transactions[key] = '+'.join([ str(transactions.get(x, None) or self[x].resolve()) for x in shard_keys ])
+
+                    if errors:
+                        if len(commits) == 1:
+                            exc_info = errors.values()[0]
+                            raise exc_info[0], exc_info[1], exc_info[2]
+                        raise VersionsCommitError(dict([ (x, y[1]) for x, y in errors.items() ]), transactions)
             finally:
                 self._state.reset()
+                self._state.latest_transactions = transactions
+                self._state.latest_skipped = skipped
+
+    def _drop_unchanged(self, repo, items):
+        """
+        Returns the staged items of the repository whose data differs from their latest
+        committed version. The committed versions are read from the snapshot cache, and
+        whatever is not cached is fetched with a single call to the backend. Backends that do
+        not resolve their latest revision are always read, without the cache.
+        """
+        resolved_rev = self[repo].resolve()
+
+        committed = {}
+        missing = []
+        for item in items:
+            data = resolved_rev is not None and snapshot_cache.get((repo, item, resolved_rev,)) or None
+            if data is None:
+                missing.append(item)
+            else:
+                committed[item] = data
+        if missing:
+            with stats.Timer('backend.version_many'):
+                versions = self[repo].version_many(missing, rev=resolved_rev)
+            for item, data in versions.items():
+                if resolved_rev is not None:
+                    snapshot_cache.set((repo, item, resolved_rev,), data)
+                committed[item] = data
+
+        changed = {}
+        for item, data in items.items():
+            if item in committed and (committed[item] == data or self.deserialize(committed[item]) == self.deserialize(data)):
+                continue
+            changed[item] = data
+        return changed
+
+    def _commit_all(self, commits, transactions):
+        """
+        Commits the items staged for each repository, adding the revision of every commit to
+        `transactions`. Commits to several repositories that allow it are made concurrently on
+        the commit pool. Every commit is attempted, and the exc_info of each repository that
+        failed is returned.
+        """
+        errors = {}
+        concurrent = [ x for x in commits if self[x[0]].concurrent_commits ]
+        if len(concurrent) < 2:
+            concurrent = []
+        user, message, changeset_id = self.user, self.message, self.changeset_id
+        tasks = [ (repo, commit_pool.submit(self._commit_in_thread, repo, items, user, message, changeset_id),) for repo, items in concurrent ]
+
+        concurrent_repos = set([ x[0] for x in concurrent ])
+        for repo, items in commits:
+            if repo not in concurrent_repos:
+                try:
+                    transactions[repo] = self._commit(repo, items)
+                except Exception:
+                    errors[repo] = sys.exc_info()
 
-            self._state.latest_transactions = transactions
+        for repo, task in tasks:
+            try:
+                transactions[repo] = task.get()
+            except Exception:
+                errors[repo] = sys.exc_info()
+        return errors
+
+    def _commit_in_thread(self, repo, items, user, message, changeset_id=None):
+        # Backends read the author of the commit from the revision state of the committing thread.
+        self._state.user = user
+        self._state.message = message
+        self._state.changeset_id = changeset_id
+        try:
+            return self._commit(repo, items)
+        finally:
+            # Return any repository handles this thread leased.
+            self._state.reset()
+
+    @stats.timed('backend.commit')
+    def _commit(self, repo, items):
+        return self[repo].commit(items)
+
+    def spool(self, key):
+        """
+        Returns the spool that commits the changesets of an `async` repository in the background.
+        """
+        self._spools_lock.acquire()
+        try:
+            if key not in self._spools:
+                configs = self.configs(key)
+                if 'spool_dir' in configs:
+                    directory = configs['spool_dir']
+                    if self.shard(key)[1] is not None:
+                        directory = os.path.join(directory, self.shard(key)[1])
+                else:
+                    directory = '%s.spool' % self[key].local.rstrip(os.sep)
+                self._spools[key] = CommitSpool(key, directory)
+            return self._spools[key]
+        finally:
+            self._spools_lock.release()
+
+    def drain(self, timeout=None):
+        """
+        Waits until the changesets spooled for every `async` repository are committed, and
+        returns a list of the (job, exception) pairs of those that failed since the last drain.
+        """
+        failures = []
+        for key, configs in settings.VERSIONS_REPOSITORIES.items():
+            if configs.get('async', False):
+                for repo in self.shard_keys(key):
+                    spool = self.spool(repo)
+                    spool.drain(timeout)
+                    while spool.failures:
+                        failures.append(spool.failures.pop(0))
+        return failures
 
     def stage_related_updates(self, instance, field_name, action, items=None, symmetrical=True):
         from versions.models import VersionsModel
@@ -132,11 +306,99 @@ class RevisionManager(object):
             related_field_name = field.related.get_accessor_name()
             related_action = action == 'clear' and 'remove' or action
             if issubclass(field.rel.to, VersionsModel):
+                model = field.rel.to
+
+                # Fetch the objects given by their ids with a single query.
+                ids = [ x for x in affected_items if isinstance(x, (int, long)) ]
+                if ids:
+                    objects = model.objects.get_query_set(bypass_filter=True).in_bulk(ids)
+                    missing = [ x for x in ids if x not in objects ]
+                    if missing:
+                        raise model.DoesNotExist('%s matching query does not exist: %s' % (model._meta.object_name, ', '.join([ str(x) for x in missing ])))
+                    affected_items = [ isinstance(x, (int, long)) and objects[x] or x for x in affected_items ]
+
+                # Read the related ids of all the objects whose relation is not staged yet at once,
+                # rather than in turn as each of them is staged.
+                unstaged = [ x for x in affected_items if x._versions_revision is None and not (x in self._state.pending_related_updates and related_field_name in self._state.pending_related_updates[x]) ]
+                if len(unstaged) > 1:
+                    related_ids = self.related_ids(model, [ x._get_pk_val() for x in unstaged ], [related_field_name])
+                    for item in unstaged:
+                        if related_field_name in related_ids[item._get_pk_val()]:
+                            self._state.pending_related_updates[item][related_field_name] = set(related_ids[item._get_pk_val()][related_field_name])
+
                 for item in affected_items:
-                    if isinstance(item, (int, long)):
-                        item = field.rel.to.objects.get_query_set(bypass_filter=True).get(pk=item)
                     self.stage_related_updates(item, related_field_name, related_action, [instance], symmetrical=False)
 
+    def prefetch_related(self, instances):
+        """
+        Collects the ids of the objects related to the instances with one query per relation
+        of each model, rather than one per relation of every instance, for `data` to use
+        instead of querying them again.
+        """
+        pks = defaultdict(set)
+        for instance in instances:
+            # The related ids of objects read as of a revision come from that revision.
+            if instance._versions_revision is None and instance._get_pk_val() is not None:
+                pks[instance.__class__].add(instance._get_pk_val())
+
+        for cls, cls_pks in pks.items():
+            for pk, related_ids in self.related_ids(cls, cls_pks).items():
+                self._state.prefetched_related.setdefault((cls, pk,), {}).update(related_ids)
+
+    def related_ids(self, cls, pks, names=None):
+        """
+        Returns a dictionary mapping each of the primary keys to the sorted ids of the objects
+        related to that object of the model, by relation name. Only the relations in `names`
+        are read if it is given, and relations that are filtered by their related manager are
+        left out.
+        """
+        from versions.models import VersionsModel
+
+        pks = list(pks)
+        results = dict([ (x, {},) for x in pks ])
+        qn = connection.ops.quote_name
+        for name, field in cls._versions_plan.relations:
+            if names is not None and name not in names:
+                continue
+            if isinstance(field, related.RelatedObject):
+                model = field.model
+            else:
+                model = field.rel.to
+
+            if isinstance(field, related.RelatedObject) and isinstance(field.field, related.ForeignKey):
+                if field.field.rel.get_related_field() != cls._meta.pk:
+                    continue
+                if issubclass(model, VersionsModel):
+                    query_set = model._default_manager.get_query_set(bypass_filter=True)
+                else:
+                    query_set = model._default_manager.all()
+                def query(chunk, query_set=query_set, field=field.field):
+                    return query_set.filter(**{'%s__in' % field.name: chunk}).values_list(field.attname, 'pk')
+            else:
+                # Many to many relations are read from their join table, which is only what the
+                # related managers return when they do not filter the related objects.
+                if not issubclass(model, VersionsModel) and model._default_manager.__class__.get_query_set.im_func is not models.Manager.get_query_set.im_func:
+                    continue
+                if isinstance(field, related.RelatedObject):
+                    table, source, target = field.field.m2m_db_table(), field.field.m2m_reverse_name(), field.field.m2m_column_name()
+                else:
+                    table, source, target = field.m2m_db_table(), field.m2m_column_name(), field.m2m_reverse_name()
+                def query(chunk, table=table, source=source, target=target):
+                    cursor = connection.cursor()
+                    cursor.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (
+                        qn(source), qn(target), qn(table), qn(source), ', '.join(['%s'] * len(chunk))), chunk)
+                    return cursor.fetchall()
+
+            related_ids = dict([ (x, set([]),) for x in pks ])
+            with stats.Timer('revision.data.related_batch'):
+                for offset in xrange(0, len(pks), RELATED_QUERY_CHUNK_SIZE):
+                    stats.incr('revision.data.related_batch_queries')
+                    for pk, related_pk in query(pks[offset:offset + RELATED_QUERY_CHUNK_SIZE]):
+                        related_ids[pk].add(related_pk)
+            for pk, ids in related_ids.items():
+                results[pk][name] = sorted(ids)
+        return results
+
     def stage(self, instance):
         self.assert_active()
 
@@ -145,12 +407,13 @@ class RevisionManager(object):
 
         # Only stage the objects once we are completing our
         if self._state.is_finishing:
-            self._state.pending_objects.discard(instance)
+            with stats.Timer('revision.stage'):
+                self._state.pending_objects.discard(instance)
 
-            data = self.serialize(instance)
-            self._state.staged_objects[repo][item] = data
+                data = self.serialize(instance)
+                self._state.staged_objects[repo][item] = data
 
-            signals.post_stage.send(sender=instance.__class__, instance=instance)
+                signals.post_stage.send(sender=instance.__class__, instance=instance)
         else:
             self._state.pending_objects.add(instance)
 
@@ -160,34 +423,32 @@ class RevisionManager(object):
         else:
             return self.version(instance, rev=rev)['related'].get(field_name, [])
 
+    @stats.timed('revision.serialize')
     def serialize(self, instance):
-        return pickle.dumps(self.data(instance))
+        configs = self.configs(self.repository_path(instance.__class__, instance._get_pk_val()))
+        return codec.encode(self.data(instance), configs.get('codec', codec.DEFAULT_CODEC), configs.get('compress', False))
 
+    @stats.timed('revision.deserialize')
     def deserialize(self, data):
-        return pickle.loads(data)
+        return codec.decode(data)
 
     def data(self, instance):
         from versions.models import VersionsModel
-        field_names = [ x.name for x in instance._meta.fields if not x.primary_key ]
-
-        if instance._versions_options.include:
-            field_names = [ x for x in field_names if x in (instance._versions_options.include + instance._versions_options.core_include) ]
-        elif instance._versions_options.exclude:
-            field_names = [ x for x in field_names if x not in instance._versions_options.exclude ]
+        plan = instance._versions_plan
 
-        field_data = dict([ (x[0], x[1],) for x in instance.__dict__.items() if x[0] in field_names ])
+        values = instance.__dict__
+        field_data = dict([ (x, values[x],) for x in plan.fields if x in values ])
         related_data = {}
+        prefetched = self._state.prefetched_related.get((instance.__class__, instance._get_pk_val(),), {})
 
-        try:
-            name_map = instance._meta._name_map
-        except AttributeError:
-            name_map = instance._meta.init_name_map()
-
-        for name, data in name_map.items():
-            if isinstance(data[0], (related.RelatedObject, related.ManyToManyField)):
-                if instance in self._state.pending_related_updates and name in self._state.pending_related_updates[instance]:
-                    related_data[name] = sorted(list(self._state.pending_related_updates[instance][name]))
-                else:
+        for name, field in plan.relations:
+            if instance in self._state.pending_related_updates and name in self._state.pending_related_updates[instance]:
+                related_data[name] = sorted(list(self._state.pending_related_updates[instance][name]))
+            elif name in prefetched:
+                related_data[name] = prefetched[name]
+            else:
+                stats.incr('revision.data.related_queries')
+                with stats.Timer('revision.data.related'):
                     manager = getattr(instance, name)
                     if issubclass(manager.model, VersionsModel):
                         related_data[name] = sorted([ x['pk'] for x in manager.get_query_set(bypass_filter=True).values('pk') ])
@@ -202,24 +463,76 @@ class RevisionManager(object):
     def _version(self, cls, pk, rev=None):
         repo = self.repository_path(cls, pk)
         item = self.item_path(cls, pk)
-        key = (item, rev,)
-        if key in self._state.cache:
-            data = self._state.cache[key]
-        else:
-            data = self[repo].version(item, rev=rev)
-            self._state.cache[key] = data
+        rev = self.shard_revision(repo, rev)
+
+        # Symbolic revisions (such as `tip`) are resolved to an immutable revision id first, so
+        # that the shared cache only ever holds data for revisions that can never change.
+        resolved_rev = self[repo].resolve(rev)
+        if resolved_rev is None:
+            with stats.Timer('backend.version'):
+                data = self[repo].version(item, rev=rev)
+            return self.deserialize(data)
+
+        key = (repo, item, resolved_rev,)
+        data = snapshot_cache.get(key)
+        if data is None:
+            with stats.Timer('backend.version'):
+                data = self[repo].version(item, rev=resolved_rev)
+            snapshot_cache.set(key, data)
         return self.deserialize(data)
 
+    def _version_many(self, cls, pks, rev=None):
+        """
+        Returns a dictionary mapping each of the primary keys to the data of that object at
+        the given revision, fetching everything that is not cached with one call per repository.
+        Objects that did not exist at the revision are omitted.
+        """
+        items = defaultdict(dict)
+        for pk in pks:
+            items[self.repository_path(cls, pk)][self.item_path(cls, pk)] = pk
+
+        results = {}
+        for repo, repo_items in items.items():
+            repo_rev = self.shard_revision(repo, rev)
+            resolved_rev = self[repo].resolve(repo_rev)
+            if resolved_rev is None:
+                missing = repo_items.keys()
+            else:
+                missing = []
+                for item, pk in repo_items.items():
+                    data = snapshot_cache.get((repo, item, resolved_rev,))
+                    if data is None:
+                        missing.append(item)
+                    else:
+                        results[pk] = self.deserialize(data)
+
+            if missing:
+                with stats.Timer('backend.version_many'):
+                    versions = self[repo].version_many(missing, rev=resolved_rev is None and repo_rev or resolved_rev)
+                for item, data in versions.items():
+                    if resolved_rev is not None:
+                        snapshot_cache.set((repo, item, resolved_rev,), data)
+                    results[repo_items[item]] = self.deserialize(data)
+        return results
+
     def version(self, instance, rev=None):
         return self._version(instance.__class__, instance._get_pk_val(), rev=rev)
 
-    def _versions(self, cls, pk):
+    def _versions(self, cls, pk, **kwargs):
+        repo = self.repository_path(cls, pk)
+        item = self.item_path(cls, pk)
+        return self[repo].versions(item, **kwargs)
+
+    def versions(self, instance, **kwargs):
+        return self._versions(instance.__class__, instance._get_pk_val(), **kwargs)
+
+    def _history(self, cls, pk):
         repo = self.repository_path(cls, pk)
         item = self.item_path(cls, pk)
-        return self[repo].versions(item)
+        return History(self[repo], item)
 
-    def versions(self, instance):
-        return self._versions(instance.__class__, instance._get_pk_val())
+    def history(self, instance):
+        return self._history(instance.__class__, instance._get_pk_val())
 
     def diff(self, instance, rev0, rev1=None):
         inst0 = self.version(instance, rev0)
@@ -234,19 +547,86 @@ class RevisionManager(object):
         return difference
 
     def repository_path(self, cls, pk):
-        return cls._versions_options.repository
+        repo = cls._versions_options.repository
+        shards = settings.VERSIONS_REPOSITORIES.get(repo, {}).get('shards', None)
+        if shards:
+            return shard_key(repo, self.item_path(cls, pk), shards)
+        return repo
+
+    def shard(self, key):
+        """
+        Returns the configured repository of a repository key, along with the number of its
+        shard (as a string), or `None` for keys that are not the key of a shard.
+        """
+        if key not in settings.VERSIONS_REPOSITORIES and '.' in key:
+            repo, shard = key.rsplit('.', 1)
+            if settings.VERSIONS_REPOSITORIES.get(repo, {}).get('shards', None) and shard.isdigit():
+                return repo, shard
+        return key, None
+
+    def shard_keys(self, key):
+        """
+        Returns the keys of all the shards of a configured repository.
+        """
+        shards = settings.VERSIONS_REPOSITORIES.get(key, {}).get('shards', None)
+        if shards:
+            return [ '%s.%s' % (key, x) for x in xrange(shards) ]
+        return [key]
+
+    def shard_revision(self, key, rev):
+        """
+        Returns the revision of the shard `key` that is part of a logical revision of a sharded
+        repository, or of the logical changeset that a revision of another of its shards (as
+        listed in the history of an object) is part of. Any other revision is returned as is.
+        """
+        repo, shard = self.shard(key)
+        if shard is None or rev is None or rev == 'tip':
+            return rev
+
+        rev = str(rev)
+        if '+' in rev:
+            revs = rev.split('+')
+            shards = self.configs(key)['shards']
+            if len(revs) != shards:
+                raise VersionDoesNotExist('Revision `%s` joins the revisions of %s shards, but `%s` is split into %s shards.' % (rev, len(revs), repo, shards))
+            return revs[int(shard)]
+
+        try:
+            self[key].resolve(rev)
+        except VersionDoesNotExist:
+            pass
+        else:
+            return rev
+        for other in self.shard_keys(repo):
+            if other != key:
+                try:
+                    changeset_key = self[other].changeset_key(rev)
+                except VersionDoesNotExist:
+                    continue
+                return self[key].changeset_before(changeset_key)
+        raise VersionDoesNotExist('Revision `%s` does not exist in any of the shards of `%s`.' % (rev, repo))
+
+    def configs(self, key):
+        return settings.VERSIONS_REPOSITORIES.get(self.shard(key)[0], {})
 
     def item_path(self, cls, pk):
         return os.path.join(cls.__module__.lower(), cls.__name__.lower(), str(pk))
 
     def __getitem__(self, key):
         if key not in self._repos:
-            if key in settings.VERSIONS_REPOSITORIES:
-                configs = settings.VERSIONS_REPOSITORIES[key]
+            repo, shard = self.shard(key)
+            if repo in settings.VERSIONS_REPOSITORIES:
+                configs = settings.VERSIONS_REPOSITORIES[repo]
                 if 'backend' not in configs or 'local' not in configs:
-                    raise ImproperlyConfigured('You must specify all required conifguration attributes for the `%s` versions backend.' % key)
+                    raise ImproperlyConfigured('You must specify all required conifguration attributes for the `%s` versions backend.' % repo)
                 backend = load_backend(configs['backend'])
-                self._repos[key] = backend.Repository(key, configs['local'], configs.get('remote', None))
+                local, remote = configs['local'], configs.get('remote', None)
+                if shard is not None:
+                    # Every shard is stored in its own repository, within the configured one.
+                    local = os.path.join(local, shard)
+                    if remote:
+                        remote = '%s/%s' % (remote.rstrip('/'), shard)
+                self._repos[key] = backend.Repository(key, local, remote, options=configs)
         return self._repos[key]
 
     def _set_user(self, val):
@@ -282,6 +662,14 @@ class RevisionManager(object):
 
     message = property(_get_message, _set_message)
 
+    def _set_changeset_id(self, val):
+        self._state.changeset_id = val
+
+    def _get_changeset_id(self):
+        return self._state.changeset_id
+
+    changeset_id = property(_get_changeset_id, _set_changeset_id)
+
 
     def __enter__(self):
         """Enters a block of revision management."""
@@ -308,6 +696,19 @@ class RevisionManager(object):
             return result
         return wraps(func)(_commit_on_success)
 
+def new_changeset_id():
+    """
+    Returns a new id for a logical changeset of a sharded repository, which sorts by the time
+    the changeset was made.
+    """
+    return '%020.6f-%s' % (time.time(), uuid.uuid4().hex[:8])
+
+def shard_key(key, item, shards):
+    """
+    Returns the key of the shard of the repository `key` that stores `item`.
+    """
+    return '%s.%s' % (key, int(md5_constructor(item).hexdigest()[:8], 16) % shards)
+
 class Version(object):
     def __init__(self, commit):
         self._commit = commit
@@ -345,19 +746,30 @@ class Version(object):
         else:
             raise VersionsMultipleParents('Found multiple parents for commit %s.' % self.revision)
 
+    def resolve_users(cls, versions):
+        """
+        Looks up the users of all the given versions with a single query.
+        """
+        pending = defaultdict(list)
+        for version in versions:
+            if isinstance(version, Version) and not hasattr(version, '_user'):
+                try:
+                    pk = int(version._commit.user())
+                except (TypeError, ValueError):
+                    pk = None
+                pending[pk].append(version)
+
+        users = User.objects.in_bulk([ x for x in pending.keys() if x is not None ])
+        for pk, user_versions in pending.items():
+            user = users.get(pk, None) or AnonymousUser()
+            for version in user_versions:
+                version._user = user
+    resolve_users = classmethod(resolve_users)
+
     @property
     def user(self):
         if not hasattr(self, '_user'):
-            val = self._commit.user()
-            if val is None:
-                user = AnonymousUser()
-            else:
-                try:
-                    self._user = User.objects.get(pk=val)
-                except User.DoesNotExist:
-                    self._user = AnonymousUser()
-                except ValueError:
-                    self._user = AnonymousUser()
+            Version.resolve_users([self])
         return self._user
 
     @property
@@ -369,5 +781,88 @@ class Version(object):
         t, tz = self._commit.date()
         return datetime.datetime.fromtimestamp(time.mktime(time.gmtime(t - tz)))
 
+class History(object):
+    """
+    The versions of an item, newest first. Versions are only read from the repository when the
+    history is sliced, indexed or iterated, and slices are paginated by the repository itself.
+    """
+    def __init__(self, repository, item, bounds=None, reverse=False):
+        self.repository = repository
+        self.item = item
+        self._bounds = bounds or {}
+        self._reverse = reverse
+        self._count = None
+        self._result_cache = None
+
+    def _fetch(self, limit=None, offset=0):
+        with stats.Timer('backend.versions'):
+            versions = list(self.repository.versions(self.item, limit=limit, offset=offset, reverse=self._reverse, **self._bounds))
+        Version.resolve_users(versions)
+        return versions
+
+    def filter(self, before=None, after=None, since=None, until=None):
+        """
+        Returns the versions committed between the `after` and `before` revisions (exclusive),
+        and between the `since` and `until` dates (inclusive).
+        """
+        bounds = self._bounds.copy()
+        for name, value in (('before', before), ('after', after), ('since', since), ('until', until)):
+            if value is not None:
+                bounds[name] = value
+        return History(self.repository, self.item, bounds, self._reverse)
+
+    def reverse(self):
+        return History(self.repository, self.item, self._bounds, not self._reverse)
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            with stats.Timer('backend.count'):
+                self._count = self.repository.count(self.item, **self._bounds)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        if self._result_cache is None:
+            self._result_cache = self._fetch()
+        return iter(self._result_cache)
+
+    def __nonzero__(self):
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return bool(self._fetch(limit=1))
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+
+        if isinstance(k, slice):
+            if k.step is not None or (k.start is not None and k.start < 0) or (k.stop is not None and k.stop < 0):
+                return list(self)[k]
+            offset = k.start or 0
+            if k.stop is None:
+                return self._fetch(offset=offset)
+            return self._fetch(limit=max(k.stop - offset, 0), offset=offset)
+
+        if k < 0:
+            return list(self)[k]
+        versions = self._fetch(limit=1, offset=k)
+        if not versions:
+            raise IndexError('History index out of range.')
+        return versions[0]
+
+    def __eq__(self, other):
+        if isinstance(other, History):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<History of %s>' % self.item
 
 revision = RevisionManager()
@@ -0,0 +1,107 @@
+import threading
+
+from django.conf import settings
+
+from versions import stats
+
+# The default memory budget, in bytes, of the process wide snapshot cache.
+DEFAULT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+class SnapshotCache(object):
+    """
+    A thread safe, least recently used cache of the raw data of historical snapshots, bounded
+    by the total number of bytes stored. Keys must only ever refer to immutable revisions.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # Entries are kept in a circular doubly linked list of [previous, next, key, value, size],
+            # with the most recently used entry directly after the root.
+            self._root = [None, None, None, None, 0]
+            self._root[0] = self._root[1] = self._root
+            self._entries = {}
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._unlink(entry)
+                self._link(entry)
+        finally:
+            self._lock.release()
+
+        if entry is None:
+            stats.incr('cache.misses')
+            return None
+        stats.incr('cache.hits')
+        return entry[3]
+
+    def set(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+                self.size -= entry[4]
+
+            while self.size + size > self.max_bytes:
+                oldest = self._root[0]
+                self._unlink(oldest)
+                del self._entries[oldest[2]]
+                self.size -= oldest[4]
+                self.evictions += 1
+
+            entry = [None, None, key, value, size]
+            self._link(entry)
+            self._entries[key] = entry
+            self.size += size
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _link(self, entry):
+        entry[0] = self._root
+        entry[1] = self._root[1]
+        self._root[1][0] = entry
+        self._root[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+snapshot_cache = SnapshotCache(getattr(settings, 'VERSIONS_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
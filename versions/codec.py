@@ -0,0 +1,152 @@
+import datetime
+import decimal
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from versions.exceptions import VersionsException
+
+# Every encoded snapshot, except for uncompressed pickles, starts with a header made up of
+# HEADER_MAGIC, the codec identifier, the format version and a byte of flags. Pickles never
+# start with a null byte, so legacy snapshots can always be told apart from encoded ones.
+HEADER_MAGIC = '\x00'
+HEADER_SIZE = 4
+FORMAT_VERSION = 1
+FLAG_ZLIB = 1
+
+DEFAULT_CODEC = 'pickle'
+
+class BaseCodec(object):
+    # A single character that identifies this codec in the header of encoded snapshots.
+    identifier = None
+
+    def dumps(self, data):
+        raise NotImplementedError
+
+    def loads(self, payload):
+        raise NotImplementedError
+
+class PickleCodec(BaseCodec):
+    identifier = 'p'
+
+    def dumps(self, data):
+        return pickle.dumps(data)
+
+    def loads(self, payload):
+        return pickle.loads(payload)
+
+class JSONCodec(BaseCodec):
+    """
+    A compact and deterministic encoding of snapshot data, which does not depend on the
+    layout of any Python classes. Values JSON cannot represent are stored as tagged objects.
+    """
+    identifier = 'j'
+
+    def dumps(self, data):
+        return simplejson.dumps(data, sort_keys=True, separators=(',', ':'), default=self._encode_value)
+
+    def loads(self, payload):
+        return simplejson.loads(payload, object_hook=self._decode_value)
+
+    def _encode_value(self, value):
+        if isinstance(value, datetime.datetime):
+            return {'__type__': 'datetime', 'value': [value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond]}
+        elif isinstance(value, datetime.date):
+            return {'__type__': 'date', 'value': [value.year, value.month, value.day]}
+        elif isinstance(value, datetime.time):
+            return {'__type__': 'time', 'value': [value.hour, value.minute, value.second, value.microsecond]}
+        elif isinstance(value, decimal.Decimal):
+            return {'__type__': 'decimal', 'value': str(value)}
+        elif isinstance(value, (set, frozenset)):
+            return sorted(value)
+        raise TypeError('%r is not JSON serializable' % value)
+
+    def _decode_value(self, value):
+        value_type = value.get('__type__', None)
+        if value_type == 'datetime':
+            return datetime.datetime(*value['value'])
+        elif value_type == 'date':
+            return datetime.date(*value['value'])
+        elif value_type == 'time':
+            return datetime.time(*value['value'])
+        elif value_type == 'decimal':
+            return decimal.Decimal(value['value'])
+        return value
+
+_codecs = {
+    'pickle': PickleCodec(),
+    'json': JSONCodec(),
+    }
+
+def get_codec(name):
+    """
+    Returns the codec registered as `name`, or loads a codec class from its dotted path.
+    """
+    if name not in _codecs:
+        if '.' not in name:
+            raise ImproperlyConfigured('`%s` is not a known versions codec.' % name)
+        module_name, class_name = name.rsplit('.', 1)
+        codec = getattr(import_module(module_name), class_name)()
+        for existing in _codecs.values():
+            if existing.identifier == codec.identifier:
+                raise VersionsException('The codec `%s` uses the identifier `%s`, which is already used by %r.' % (name, codec.identifier, existing))
+        _codecs[name] = codec
+    return _codecs[name]
+
+def load_codecs():
+    """
+    Registers every codec configured for a repository in `VERSIONS_REPOSITORIES`, along with
+    those listed in `VERSIONS_CODECS`, so that snapshots they wrote can be decoded before any
+    snapshot was encoded with them.
+    """
+    names = list(getattr(settings, 'VERSIONS_CODECS', []))
+    names.extend([ x['codec'] for x in settings.VERSIONS_REPOSITORIES.values() if 'codec' in x ])
+    for name in names:
+        get_codec(name)
+
+def _find_codec(identifier):
+    for codec in _codecs.values():
+        if codec.identifier == identifier:
+            return codec
+    return None
+
+def encode(data, codec=DEFAULT_CODEC, compress=False):
+    codec = get_codec(codec)
+    payload = codec.dumps(data)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+
+    # Uncompressed pickles are written without a header, so that they remain readable by older releases.
+    if isinstance(codec, PickleCodec) and not flags:
+        return payload
+    return HEADER_MAGIC + codec.identifier + chr(FORMAT_VERSION) + chr(flags) + payload
+
+def decode(payload):
+    if not payload.startswith(HEADER_MAGIC):
+        return pickle.loads(payload)
+
+    identifier, version, flags = payload[1], ord(payload[2]), ord(payload[3])
+    if version > FORMAT_VERSION:
+        raise VersionsException('Unable to decode a snapshot written with format version %s.' % version)
+
+    codec = _find_codec(identifier)
+    if codec is None:
+        load_codecs()
+        codec = _find_codec(identifier)
+    if codec is None:
+        raise VersionsException('Unable to decode a snapshot written with the unknown codec `%s`.' % identifier)
+
+    payload = payload[HEADER_SIZE:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    return codec.loads(payload)
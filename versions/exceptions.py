@@ -9,3 +9,16 @@ class VersionsMultipleParents(VersionsException):
 
 class VersionsManagementException(VersionsException):
     pass
+
+class VersionsCommitError(VersionsException):
+    """
+    Raised when the commits to some of the repositories of a revision failed. The commits to
+    the other repositories are kept, and their revisions are listed in `transactions`.
+    """
+    def __init__(self, errors, transactions):
+        self.errors = errors
+        self.transactions = transactions
+        super(VersionsCommitError, self).__init__('Unable to commit to the %s repositories: %s' % (
+            ', '.join(sorted(errors.keys())),
+            '; '.join([ '%s: %s' % (x, errors[x]) for x in sorted(errors.keys()) ]),
+            ))
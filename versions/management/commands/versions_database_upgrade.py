@@ -0,0 +1,148 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+from django.utils.encoding import smart_str
+
+from versions.base import revision
+
+class Command(NoArgsCommand):
+    help = "Upgrade the tables of the database versions backend to the latest schema, convert existing revisions to compressed binary payloads, and record the head of every path, the parent of every changeset and the latest changeset."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=500,
+            help='The number of revisions to convert in each database transaction.'),
+        )
+
+    def handle_noargs(self, **options):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Changeset, Head, Revision, Tip
+
+        batch_size = int(options.get('batch_size', 500))
+        verbosity = int(options.get('verbosity', 1))
+
+        self.create_missing_tables((Head, Tip,), verbosity)
+        self.add_missing_columns(Changeset, ('parent_changeset',), verbosity)
+        self.add_missing_columns(Revision, ('payload', 'codec',), verbosity)
+        self.add_unique_index(Revision, ('path', 'changeset',), verbosity)
+
+        # Use the compression settings of a configured database repository, if there is one.
+        repository = Repository('database')
+        for key, configs in settings.VERSIONS_REPOSITORIES.items():
+            if configs.get('backend', None) == 'versions.backends.database':
+                repository = revision[key]
+                break
+
+        converted = 0
+        while True:
+            rows = list(Revision.objects.filter(payload__isnull=True).order_by('pk').values_list('pk', 'data')[:batch_size])
+            if not rows:
+                break
+            for pk, data in rows:
+                payload, codec = repository.encode_payload(smart_str(data))
+                Revision.objects.filter(pk=pk).update(data='', payload=payload, codec=codec)
+            transaction.commit_unless_managed()
+            converted += len(rows)
+
+        if verbosity > 0:
+            print 'Converted %s revisions to binary payloads.' % converted
+
+        self.record_heads(Head, Revision, verbosity)
+        self.record_parents(Changeset, batch_size, verbosity)
+        self.record_tip(Tip, Changeset)
+
+    def record_parents(self, model, batch_size, verbosity):
+        recorded = 0
+        parent = None
+        for pk, parent_pk in model.objects.order_by('pk').values_list('pk', 'parent_changeset').iterator():
+            if parent_pk is None and parent is not None:
+                model.objects.filter(pk=pk).update(parent_changeset=parent)
+                recorded += 1
+                if recorded % batch_size == 0:
+                    transaction.commit_unless_managed()
+            parent = pk
+        transaction.commit_unless_managed()
+        if verbosity > 0:
+            print 'Recorded the parent of %s changesets.' % recorded
+
+    def record_tip(self, tip_model, changeset_model):
+        from versions.backends.database.base import TIP_PK
+        if not tip_model.objects.filter(pk=TIP_PK).count():
+            tip_model.objects.create(pk=TIP_PK, changeset_id=changeset_model.objects.aggregate(tip=Max('pk'))['tip'])
+            transaction.commit_unless_managed()
+
+    def record_heads(self, head_model, revision_model, verbosity):
+        qn = connection.ops.quote_name
+        head_table = qn(head_model._meta.db_table)
+        revision_table = qn(revision_model._meta.db_table)
+        path_column = qn(revision_model._meta.get_field('path').column)
+        changeset_column = qn(revision_model._meta.get_field('changeset').column)
+
+        cursor = connection.cursor()
+        cursor.execute('INSERT INTO %s (%s, %s) SELECT %s, MAX(%s) FROM %s WHERE %s NOT IN (SELECT %s FROM %s) GROUP BY %s' % (
+            head_table, qn(head_model._meta.get_field('path').column), qn(head_model._meta.get_field('changeset').column),
+            path_column, changeset_column, revision_table,
+            path_column, qn(head_model._meta.get_field('path').column), head_table,
+            path_column,
+            ))
+        transaction.commit_unless_managed()
+        if verbosity > 0:
+            print 'Recorded the head of %s paths.' % cursor.rowcount
+
+    def add_unique_index(self, model, field_names, verbosity):
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        columns = [ model._meta.get_field(x).column for x in field_names ]
+        index_name = '%s_%s' % (table, '_'.join(field_names))
+        cursor = connection.cursor()
+        sid = transaction.savepoint()
+        try:
+            cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (qn(index_name), qn(table), ', '.join([ qn(x) for x in columns ])))
+        except DatabaseError:
+            # The index (or the equivalent unique constraint of a newly created table) already exists.
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+            transaction.commit_unless_managed()
+            if verbosity > 0:
+                print 'Added index %s to %s.' % (index_name, table)
+
+    def create_missing_tables(self, models, verbosity):
+        from django.core.management.color import no_style
+        style = no_style()
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names()
+        for model in models:
+            if model._meta.db_table in tables:
+                continue
+            if verbosity > 0:
+                print 'Creating table %s' % model._meta.db_table
+            sql, references = connection.creation.sql_create_model(model, style, set(connection.introspection.installed_models(tables)))
+            for statement in sql + connection.creation.sql_indexes_for_model(model, style):
+                cursor.execute(statement)
+        transaction.commit_unless_managed()
+
+    def add_missing_columns(self, model, field_names, verbosity):
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        table = model._meta.db_table
+        cursor.execute('SELECT * FROM %s WHERE 1 = 0' % qn(table))
+        columns = [ x[0] for x in cursor.description ]
+        for name in field_names:
+            field = model._meta.get_field(name)
+            if field.column in columns:
+                continue
+            sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (qn(table), qn(field.column), field.db_type())
+            if field.null:
+                sql += ' NULL'
+            else:
+                default = field.get_default()
+                if isinstance(default, basestring):
+                    default = "'%s'" % default.replace("'", "''")
+                sql += ' NOT NULL DEFAULT %s' % default
+            if verbosity > 0:
+                print 'Adding column %s to %s.' % (field.column, table)
+            cursor.execute(sql)
+        transaction.commit_unless_managed()
@@ -0,0 +1,95 @@
+from collections import defaultdict
+from optparse import make_option
+import os
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+
+from versions.base import new_changeset_id, revision, shard_key
+from versions.utils import load_backend
+
+# The number of changesets replayed between progress reports.
+PROGRESS_INTERVAL = 1000
+
+class Command(BaseCommand):
+    help = "Copy the history of a repository into a new set of shards. Run this while nothing commits to the repository, then point its `local` setting at the destination and set `shards`."
+    args = '[repository]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--shards', action='store', dest='shards', type='int', default=None,
+            help='The number of shards to split the repository into.'),
+        make_option('--destination', action='store', dest='destination', default=None,
+            help='The directory in which to create the shards, which must not exist yet.'),
+        )
+
+    def handle(self, key='default', **options):
+        shards = options.get('shards', None)
+        destination = options.get('destination', None)
+        verbosity = int(options.get('verbosity', 1))
+
+        if key not in settings.VERSIONS_REPOSITORIES:
+            raise CommandError('`%s` is not a configured versions repository.' % key)
+        if not shards or shards < 1:
+            raise CommandError('The number of shards must be at least 1.')
+        if not destination:
+            raise CommandError('You must specify a destination directory.')
+        if os.path.exists(destination):
+            raise CommandError('The destination `%s` already exists.' % destination)
+
+        configs = settings.VERSIONS_REPOSITORIES[key]
+        if configs['backend'] == 'versions.backends.database':
+            raise CommandError('Only repositories stored on disk can be resharded.')
+        backend = load_backend(configs['backend'])
+        sources = [ revision[x] for x in revision.shard_keys(key) ]
+        # The shards are written through keys of their own, so they never share state with the sources.
+        targets = [ backend.Repository('%s-reshard.%s' % (key, x), os.path.join(destination, str(x)), options=configs) for x in xrange(shards) ]
+
+        # The commits that the shards received from one logical changeset are grouped together again,
+        # by the changeset id they recorded or, for older commits, by their user, message and time.
+        groups = {}
+        for index, source in enumerate(sources):
+            ids = dict([ (x[0], (x[1], x[2],),) for x in source.changeset_ids() ])
+            occurrences = defaultdict(int)
+            for position, (rev, user, message, date, items) in enumerate(source.changesets()):
+                changeset_id, timestamp = ids[rev]
+                if changeset_id is None:
+                    # The n-th of several such commits to a shard is only grouped with the n-th of the others.
+                    group_key = (user, message, timestamp,)
+                    occurrences[group_key] += 1
+                    group_key += (occurrences[group_key],)
+                    order_key = '%020.6f' % timestamp
+                else:
+                    group_key = order_key = changeset_id
+                if group_key not in groups:
+                    groups[group_key] = ((order_key, index, position,), changeset_id, user, message, [],)
+                groups[group_key][4].append((source, rev, items,))
+        changesets = sorted(groups.values(), key=lambda x: x[0])
+
+        for target in targets:
+            target.begin_bulk()
+        for count, (order, changeset_id, user, message, commits) in enumerate(changesets):
+            changes = defaultdict(dict)
+            for source, rev, items in commits:
+                for item, data in source.version_many(items, rev=rev).items():
+                    changes[int(shard_key(key, item, shards).rsplit('.', 1)[1])][item] = data
+
+            try:
+                revision.user = User(pk=int(user))
+            except (TypeError, ValueError):
+                revision.user = AnonymousUser()
+            revision.message = message
+            revision.changeset_id = changeset_id or new_changeset_id()
+            for shard, items in sorted(changes.items()):
+                targets[shard].commit(items)
+
+            if verbosity > 0 and (count + 1) % PROGRESS_INTERVAL == 0:
+                print 'Replayed %s of %s changesets.' % (count + 1, len(changesets))
+        revision._state.reset()
+
+        for target in targets:
+            target.end_bulk()
+            if hasattr(target, 'close'):
+                target.close()
+        if verbosity > 0:
+            print 'Replayed %s changesets into %s shards in %s.' % (len(changesets), shards, destination)
@@ -1,31 +1,185 @@
 from __future__ import with_statement
 
+from optparse import make_option
+import os
+import sys
+import time
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None  # Python 2.5 fallback, parallel workers are unavailable.
+
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
-from django.core.management.base import BaseCommand, NoArgsCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from versions.base import revision
 from versions.models import VersionsModel
 
-class Command(NoArgsCommand):
+# The minimum number of instances to fetch from the database per query.
+FETCH_CHUNK_SIZE = 100
+
+# The minimum number of seconds between progress reports for a model.
+PROGRESS_INTERVAL = 5
+
+class Command(BaseCommand):
     help = "Setup your django-versions repositories and create a baseline revision for all existing data in your models."
+    args = '[appname.ModelName ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=1,
+            help='The number of instances to commit in each baseline changeset.'),
+        make_option('--checkpoint-dir', action='store', dest='checkpoint_dir', default=None,
+            help='A directory in which to record the progress of each model, so that an interrupted baseline can be resumed.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=1,
+            help='The number of worker processes used to baseline models in parallel.'),
+        )
 
     requires_model_validation = True
 
-    def handle_noargs(self, **options):
-        from django.db.models.loading import get_models
-
-        models = get_models(include_deferred=True)
-        for model in models:
-            if issubclass(model, VersionsModel):
-                instance_count = model.objects.count()
-                model_name = '%s.%s' % (model._meta.app_label, model._meta.module_name)
-                print 'Creating baseline revisions for %s `%s` objects.' % (
-                    instance_count,
-                    model_name,
-                    )
-
-                for instance in model.objects.iterator():
-                    with revision:
-                        revision.message = 'Baseline creation of model data for `%s` objects.' % model_name
+    def handle(self, *model_labels, **options):
+        from django.db import connection
+        from django.db.models.loading import get_model, get_models
+
+        batch_size = int(options.get('batch_size', 1))
+        checkpoint_dir = options.get('checkpoint_dir', None)
+        workers = int(options.get('workers', 1))
+        verbosity = int(options.get('verbosity', 1))
+
+        if batch_size < 1:
+            raise CommandError('The batch size must be at least 1.')
+
+        if model_labels:
+            models = []
+            for label in model_labels:
+                try:
+                    app_label, model_name = label.split('.')
+                except ValueError:
+                    raise CommandError('Models must be specified as appname.ModelName, found `%s`.' % label)
+                model = get_model(app_label, model_name)
+                if model is None or not issubclass(model, VersionsModel):
+                    raise CommandError('`%s` is not a versioned model.' % label)
+                models.append(model)
+        else:
+            models = [ x for x in get_models(include_deferred=True) if issubclass(x, VersionsModel) ]
+
+        if checkpoint_dir and not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        tasks = [ (model._meta.app_label, model.__name__, batch_size, checkpoint_dir, verbosity) for model in models ]
+        if workers > 1 and len(tasks) > 1:
+            if multiprocessing is None:
+                raise CommandError('Parallel workers require the multiprocessing module.')
+            # Each worker process must open its own database connection.
+            connection.close()
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+            try:
+                pool.map(_baseline_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                _baseline_worker(task)
+
+def _baseline_worker(task):
+    from django.db.models.loading import get_model
+    app_label, model_name, batch_size, checkpoint_dir, verbosity = task
+    baseline_model(get_model(app_label, model_name), batch_size, checkpoint_dir, verbosity)
+
+def baseline_model(model, batch_size=1, checkpoint_dir=None, verbosity=1):
+    """
+    Commits the current state of every instance of ``model``, ``batch_size`` instances per
+    changeset, walking the table in primary key order. When ``checkpoint_dir`` is given, the
+    last committed primary key is recorded after each chunk of changesets and used to resume from.
+    """
+    model_name = '%s.%s' % (model._meta.app_label, model._meta.module_name)
+    checkpoint = checkpoint_dir and Checkpoint(os.path.join(checkpoint_dir, model_name)) or None
+
+    queryset = model.objects.order_by('pk')
+    last_pk = None
+    if checkpoint:
+        last_pk = checkpoint.load(model)
+    if last_pk is not None:
+        queryset = queryset.filter(pk__gt=last_pk)
+
+    instance_count = queryset.count()
+    if verbosity > 0:
+        print 'Creating baseline revisions for %s `%s` objects.' % (
+            instance_count,
+            model_name,
+            )
+
+    committed = 0
+    started = reported = time.time()
+    fetch_size = max(batch_size, FETCH_CHUNK_SIZE)
+    while True:
+        if last_pk is None:
+            instances = list(queryset[:fetch_size])
+        else:
+            instances = list(queryset.filter(pk__gt=last_pk)[:fetch_size])
+        if not instances:
+            break
+
+        # Each chunk is committed in bulk, so that the git backend writes one packfile for it.
+        repositories = [ revision[x] for key in settings.VERSIONS_REPOSITORIES for x in revision.shard_keys(key) ]
+        for repository in repositories:
+            repository.begin_bulk()
+        try:
+            for offset in xrange(0, len(instances), batch_size):
+                batch = instances[offset:offset + batch_size]
+                with revision:
+                    revision.message = 'Baseline creation of model data for `%s` objects.' % model_name
+                    for instance in batch:
                         revision.stage(instance)
+
+                last_pk = batch[-1]._get_pk_val()
+                committed += len(batch)
+                if verbosity > 0 and time.time() - reported >= PROGRESS_INTERVAL:
+                    reported = time.time()
+                    _report_progress(model_name, committed, instance_count, reported - started)
+        finally:
+            for repository in repositories:
+                repository.end_bulk()
+
+        if checkpoint:
+            checkpoint.save(last_pk)
+
+    if verbosity > 0:
+        _report_progress(model_name, committed, instance_count, time.time() - started)
+
+def _report_progress(model_name, committed, instance_count, elapsed):
+    rate = elapsed and committed / elapsed or 0.0
+    print '  `%s`: %s/%s objects committed (%.1f objects/sec).' % (model_name, committed, instance_count, rate)
+    sys.stdout.flush()
+
+class Checkpoint(object):
+    """
+    Stores the primary key of the last instance of a model that was committed to its repository.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, model):
+        if not os.path.exists(self.path):
+            return None
+        f = open(self.path)
+        try:
+            value = f.read().strip()
+        finally:
+            f.close()
+        if not value:
+            return None
+        return model._meta.pk.to_python(value)
+
+    def save(self, pk):
+        # Write to a temporary file first so that a crash never leaves a truncated checkpoint behind.
+        temp_path = '%s.tmp' % self.path
+        f = open(temp_path, 'w')
+        try:
+            f.write(str(pk))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_path, self.path)
@@ -13,9 +13,8 @@ class VersionsManager(models.Manager):
 
     def versions(self, instance_or_cls, pk=None):
         if pk is None:
-            return [ x for x in revision.versions(instance_or_cls) ]
-        else:
-            return [ x for x in revision._versions(instance_or_cls, pk) ]
+            return revision.history(instance_or_cls)
+        return revision._history(instance_or_cls, pk)
 
     def diff(self, instance, rev0, rev1=None):
         return revision.diff(instance, rev0, rev1)
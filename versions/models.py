@@ -1,4 +1,7 @@
+import operator
+
 from django.db import models
+from django.db.models import Q
 from django.db.models.fields import related
 
 from versions.base import revision
@@ -72,30 +75,28 @@ class VersionsModel(models.Model):
         that shares the same unique constraints as our existing object. Then edit
         that existing deleted object.
         """
-        if self._get_pk_val() is None:
+        if self._get_pk_val() is None and self._versions_unique_constraints:
             base_filter = self.__class__.objects.get_query_set(self._versions_revision, include_staged_delete=True, bypass_filter=True)
-
-            for unique_together in self._meta.unique_together:
-                filters = {}
-                for field_name in unique_together:
-                    field = self._meta.get_field(field_name)
-                    filters[field.name] = field._get_val_from_obj(self)
-                try:
-                    existing_object = base_filter.filter(**filters).get()
-                except self.__class__.DoesNotExist:
-                    pass
+            constraints = [ (x, [ y._get_val_from_obj(self) for y in x ],) for x in self._versions_unique_constraints ]
+
+            # Look for objects conflicting with any of the constraints at once. The constraints are
+            # only queried one at a time when some of the objects found do not match any of them
+            # here (e.g. because the database compares the values differently).
+            query = reduce(operator.or_, [ Q(**dict([ (x.name, y,) for x, y in zip(fields, values) ])) for fields, values in constraints ])
+            matches = list(base_filter.filter(query))
+            if matches:
+                matches_by_constraint = [ [ x for x in matches if [ y._get_val_from_obj(x) for y in fields ] == values ] for fields, values in constraints ]
+                if len(set([ x.pk for y in matches_by_constraint for x in y ])) == len(matches):
+                    for existing_objects in matches_by_constraint:
+                        if len(existing_objects) > 1:
+                            raise self.__class__.MultipleObjectsReturned('get() returned more than one %s -- it returned %s!' % (self._meta.object_name, len(existing_objects)))
+                        elif existing_objects:
+                            self.pk = existing_objects[0].pk
+                            break
                 else:
-                    self.pk = existing_object.pk
-                    break
-
-            if self._get_pk_val() is None:
-                for field in self._meta.fields:
-                    if field.unique:
-                        filters = {
-                            field.name: field._get_val_from_obj(self),
-                            }
+                    for fields, values in constraints:
                         try:
-                            existing_object = base_filter.filter(**filters).get()
+                            existing_object = base_filter.filter(**dict([ (x.name, y,) for x, y in zip(fields, values) ])).get()
                         except self.__class__.DoesNotExist:
                             pass
                         else:
@@ -0,0 +1,60 @@
+import Queue
+import sys
+import threading
+
+from django.conf import settings
+
+class Task(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def get(self):
+        """
+        Waits for the task to finish, returning its result or raising its exception.
+        """
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class ThreadPool(object):
+    """
+    Runs calls for other threads on at most `size` daemon threads, which are started as needed.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            self._queue.get().run()
+
+    def submit(self, func, *args):
+        self._lock.acquire()
+        try:
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run, name='versions-pool-%s' % len(self._threads))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+        task = Task(func, args)
+        self._queue.put(task)
+        return task
+
+commit_pool = ThreadPool(getattr(settings, 'VERSIONS_COMMIT_THREADS', 4))
@@ -1,24 +1,62 @@
+from itertools import islice
+
 from django.db import connection
 from django.db.models import query
 from django.db.models import sql
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 from django.db.models.fields import related
 from django.db.models.signals import class_prepared
 from django.utils import tree
 
 from versions.base import revision
 from versions.constants import VERSIONS_STATUS_DELETED, VERSIONS_STATUS_STAGED_DELETE
-from versions.exceptions import VersionDoesNotExist, VersionsException
+from versions.exceptions import VersionsException
 from versions.fields import VersionsReverseSingleRelatedObjectDescriptor, VersionsForeignRelatedObjectsDescriptor, VersionsReverseManyRelatedObjectsDescriptor
 
 # Registry of table names to Versioned models
 _versions_table_mappings = {}
 
+class SnapshotPlan(object):
+    """
+    The fields and relations captured in the snapshots of a versioned model, worked out once
+    per model rather than for every snapshot.
+    """
+    def __init__(self, model):
+        self.model = model
+
+        field_names = [ x.name for x in model._meta.fields if not x.primary_key ]
+        if model._versions_options.include:
+            field_names = [ x for x in field_names if x in (model._versions_options.include + model._versions_options.core_include) ]
+        elif model._versions_options.exclude:
+            field_names = [ x for x in field_names if x not in model._versions_options.exclude ]
+        self.fields = tuple(field_names)
+        self._relations = None
+
+    def relations(self):
+        """
+        The names and fields of the reverse foreign key and many to many relations of the model.
+        """
+        # Reverse relations are only known once every model is loaded, so they are found on first use.
+        if self._relations is None:
+            try:
+                name_map = self.model._meta._name_map
+            except AttributeError:
+                name_map = self.model._meta.init_name_map()
+            self._relations = tuple([ (name, data[0],) for name, data in name_map.items() if isinstance(data[0], (related.RelatedObject, related.ManyToManyField)) ])
+        return self._relations
+    relations = property(relations)
+
 def setup_versioned_models(sender, **kargs):
     from versions.models import VersionsModel
     if issubclass(sender, VersionsModel):
         # Register this model with the version registry.
         qn = connection.ops.quote_name
         _versions_table_mappings[qn(sender._meta.db_table)] = sender
+        sender._versions_plan = SnapshotPlan(sender)
+        # The groups of fields that must be unique together, followed by the unique fields.
+        sender._versions_unique_constraints = tuple(
+            [ tuple([ sender._meta.get_field(x) for x in unique_together ]) for unique_together in sender._meta.unique_together ] +
+            [ (x,) for x in sender._meta.fields if x.unique and not x.primary_key ])
 
         try:
             name_map = sender._meta._name_map
@@ -108,17 +146,26 @@ class VersionsQuery(sql.Query):
                 yield row
         else:
             fields = None
+            rows = super(VersionsQuery, self).results_iter()
 
-            for row in super(VersionsQuery, self).results_iter():
-                row = list(row)
+            while True:
+                chunk = [ list(row) for row in islice(rows, GET_ITERATOR_CHUNK_SIZE) ]
+                if not chunk:
+                    break
                 if fields is None:
                     fields = self.get_field_mapping()
 
-                # Track whether this row existed at the time of the revision.
-                exists = True
+                # Fetch the data for every versioned object referenced by this chunk of rows in bulk,
+                # rather than asking the backend for each object one at a time.
                 row_data = {}
                 for field in fields.values():
-                    try:
+                    pks = set([ row[field['pk']] for row in chunk if row[field['pk']] is not None ])
+                    row_data[field['model']] = revision._version_many(field['model'], pks, rev=self._revision)
+
+                for row in chunk:
+                    # Track whether this row existed at the time of the revision.
+                    exists = True
+                    for field in fields.values():
                         # TODO: how do we handle select_related queries?
                         #    1) if the primary object does not exist at this revision, it should be skipped.
                         #    2) what about objects included in select_reated? (if the filter was only filtering on the primary object,
@@ -126,10 +173,10 @@ class VersionsQuery(sql.Query):
                         #       however, what do we do if the query filtered on the related object?
                         #    3) What if this object is only being included because the database value of the selected object at an old revision matched,
                         #       but the existing revision of that object does not?
-                        key = (field['model'], row[field['pk']],)
-                        if key not in row_data:
-                            row_data[key] = revision._version(field['model'], row[field['pk']], rev=self._revision)
-                        rev_data = row_data[key]
+                        rev_data = row_data[field['model']].get(row[field['pk']], None)
+                        if rev_data is None:
+                            exists = False
+                            break
                         field_data = rev_data.get('field', {})
                         related_data = rev_data.get('related', {})
 
@@ -144,13 +191,10 @@ class VersionsQuery(sql.Query):
                             for column in field['columns'].values():
                                 if column['position'] is not None:
                                     row[column['position']] = field_data.get(column['field'], row[column['position']])
-                    except VersionDoesNotExist:
-                        exists = False
-                        break
 
-                # If all of the objects within this row existed at the specified revision, yeild the row.
-                if exists:
-                    yield row
+                    # If all of the objects within this row existed at the specified revision, yeild the row.
+                    if exists:
+                        yield row
 
 class VersionsQuerySet(query.QuerySet):
     def __init__(self, *args, **kwargs):
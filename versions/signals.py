@@ -1,3 +1,5 @@
 from django.dispatch import Signal
 
 post_stage = Signal(providing_args=["instance"])
+commit_failed = Signal(providing_args=["repository", "job", "exception"])
+stat_recorded = Signal(providing_args=["name", "kind", "value"])
@@ -0,0 +1,170 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.contrib.auth.models import AnonymousUser, User
+
+from versions import signals
+
+# How often (in seconds) an idle committer looks for jobs spooled by other processes.
+POLL_INTERVAL = 1.0
+
+JOB_SUFFIX = '.job'
+
+class CommitSpool(object):
+    """
+    Commits changesets to a repository from a background thread. Every changeset is first
+    written to a job file in the spool directory, so changesets that were not committed when
+    the process stopped are committed once a spool for the directory is started again.
+
+    Jobs are committed one at a time in the order they were spooled, by a single committer per
+    process, and several processes can share a spool directory.
+    """
+    def __init__(self, key, directory):
+        self.key = key
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, 'failed')
+        self.failures = []
+        self.log = logging.getLogger('versions')
+
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._last_time = 0
+        self._busy = False
+        self._closed = False
+
+        for path in (self.directory, self.failed_directory):
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        self._thread = threading.Thread(target=self._run, name='versions-spool-%s' % key)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _jobs(self):
+        return sorted([ x for x in os.listdir(self.directory) if x.endswith(JOB_SUFFIX) ])
+
+    def put(self, items, user, message, changeset_id=None):
+        """
+        Spools a changeset of serialized items, to be committed by `user` with `message` as
+        part of the logical changeset `changeset_id` (if any).
+        """
+        self._condition.acquire()
+        try:
+            # Job names sort in the order they were spooled, even if the clock is set back.
+            self._last_time = max(self._last_time, int(time.time() * 1000000))
+            self._sequence += 1
+            name = '%020d-%08d-%08d%s' % (self._last_time, os.getpid(), self._sequence, JOB_SUFFIX)
+
+            # Write to a temporary file first so that a crash never leaves a truncated job behind.
+            temp_path = os.path.join(self.directory, '%s.tmp' % name)
+            f = open(temp_path, 'wb')
+            try:
+                pickle.dump({
+                    'items': items,
+                    'user': user.id,
+                    'message': message,
+                    'changeset_id': changeset_id,
+                    }, f, pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(temp_path, os.path.join(self.directory, name))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def drain(self, timeout=None):
+        """
+        Waits until every spooled job was committed (or failed), returning False if that did
+        not happen within `timeout` seconds.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        self._condition.acquire()
+        try:
+            while self._busy or self._jobs():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self._condition.notifyAll()
+                self._condition.wait(0.1)
+            return True
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """
+        Stops the committer, after it finished committing the current job. Jobs that are still
+        spooled are committed once a spool for the directory is started again.
+        """
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._closed and not self._jobs():
+                    self._condition.wait(POLL_INTERVAL)
+                if self._closed:
+                    return
+                self._busy = True
+            finally:
+                self._condition.release()
+
+            try:
+                self._commit_next()
+            finally:
+                self._condition.acquire()
+                try:
+                    self._busy = False
+                    self._condition.notifyAll()
+                finally:
+                    self._condition.release()
+
+    def _commit_next(self):
+        from versions.base import revision
+
+        # Other processes sharing the spool directory must not commit the same job.
+        lock_file = open(os.path.join(self.directory, 'spool.lock'), 'w')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            jobs = self._jobs()
+            if not jobs:
+                return
+            name = jobs[0]
+            path = os.path.join(self.directory, name)
+            try:
+                f = open(path, 'rb')
+                try:
+                    job = pickle.load(f)
+                finally:
+                    f.close()
+
+                if job['user'] is None:
+                    user = AnonymousUser()
+                else:
+                    user = User(pk=job['user'])
+                revision._commit_in_thread(self.key, job['items'], user, job['message'], job.get('changeset_id', None))
+            except Exception, e:
+                self.log.exception('Unable to commit the spooled changeset %s to the `%s` repository.' % (name, self.key))
+                os.rename(path, os.path.join(self.failed_directory, name))
+                self.failures.append((name, e,))
+                signals.commit_failed.send(sender=self.__class__, repository=self.key, job=os.path.join(self.failed_directory, name), exception=e)
+            else:
+                os.remove(path)
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
@@ -0,0 +1,181 @@
+from collections import defaultdict
+import logging
+import threading
+import time
+
+try:
+    from functools import wraps
+except ImportError:
+    from django.utils.functional import wraps  # Python 2.3, 2.4 fallback.
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from versions import signals
+
+DEFAULT_COLLECTOR = 'versions.stats.MemoryCollector'
+
+# The default number of seconds between the summaries logged by `LoggingCollector`.
+DEFAULT_LOG_INTERVAL = 60
+
+class BaseCollector(object):
+    def incr(self, name, count=1):
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+class MemoryCollector(BaseCollector):
+    """
+    Keeps the totals of every counter and timing in memory, shared by every thread of the process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.counters = defaultdict(int)
+            # The number of measurements, and their total and maximum duration.
+            self.timings = defaultdict(lambda: [0, 0.0, 0.0])
+        finally:
+            self._lock.release()
+
+    def incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] += count
+        finally:
+            self._lock.release()
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            entry = self.timings[name]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """
+        Returns the current counters, along with the count, total, mean and maximum (in
+        seconds) of every timing, and the hit ratio of the snapshot cache.
+        """
+        self._lock.acquire()
+        try:
+            counters = dict(self.counters)
+            timings = dict([ (name, {
+                'count': count,
+                'total': total,
+                'mean': total / count,
+                'max': maximum,
+                }) for name, (count, total, maximum) in self.timings.items() ])
+        finally:
+            self._lock.release()
+
+        lookups = counters.get('cache.hits', 0) + counters.get('cache.misses', 0)
+        return {
+            'counters': counters,
+            'timings': timings,
+            'cache_hit_ratio': lookups and float(counters.get('cache.hits', 0)) / lookups or None,
+            }
+
+class LoggingCollector(MemoryCollector):
+    """
+    Logs a summary of the counters and timings to the `versions` logger every
+    `VERSIONS_STATS_LOG_INTERVAL` seconds, then starts over.
+    """
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = getattr(settings, 'VERSIONS_STATS_LOG_INTERVAL', DEFAULT_LOG_INTERVAL)
+        self.interval = interval
+        self.log = logging.getLogger('versions')
+        self._exported = time.time()
+        super(LoggingCollector, self).__init__()
+
+    def incr(self, name, count=1):
+        super(LoggingCollector, self).incr(name, count)
+        self._export_due()
+
+    def timing(self, name, seconds):
+        super(LoggingCollector, self).timing(name, seconds)
+        self._export_due()
+
+    def _export_due(self):
+        if time.time() - self._exported >= self.interval:
+            self.export()
+
+    def export(self):
+        snapshot = self.snapshot()
+        self._exported = time.time()
+        self.reset()
+        for name, value in sorted(snapshot['counters'].items()):
+            self.log.info('versions stats: %s count=%s' % (name, value))
+        for name, timing in sorted(snapshot['timings'].items()):
+            self.log.info('versions stats: %s count=%s total=%.1fms mean=%.2fms max=%.2fms' % (
+                name, timing['count'], timing['total'] * 1000, timing['mean'] * 1000, timing['max'] * 1000))
+        if snapshot['cache_hit_ratio'] is not None:
+            self.log.info('versions stats: cache hit ratio=%.3f' % snapshot['cache_hit_ratio'])
+
+_collector = None
+_collector_lock = threading.Lock()
+
+def get_collector():
+    """
+    Returns the collector configured by `VERSIONS_STATS_COLLECTOR`, the dotted path of a collector class.
+    """
+    global _collector
+    if _collector is None:
+        _collector_lock.acquire()
+        try:
+            if _collector is None:
+                path = getattr(settings, 'VERSIONS_STATS_COLLECTOR', DEFAULT_COLLECTOR)
+                module_name, class_name = path.rsplit('.', 1)
+                try:
+                    _collector = getattr(import_module(module_name), class_name)()
+                except (ImportError, AttributeError), e:
+                    raise ImproperlyConfigured('Unable to load the versions stats collector `%s`: %s' % (path, e))
+        finally:
+            _collector_lock.release()
+    return _collector
+
+def incr(name, count=1):
+    get_collector().incr(name, count)
+    signals.stat_recorded.send(sender=None, name=name, kind='counter', value=count)
+
+def timing(name, seconds):
+    get_collector().timing(name, seconds)
+    signals.stat_recorded.send(sender=None, name=name, kind='timing', value=seconds)
+
+class Timer(object):
+    """
+    Records the time spent in a `with` block as the timing `name`.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timing(self.name, time.time() - self.started)
+        return False
+
+def timed(name):
+    """
+    Decorates a function to record the time spent in every call as the timing `name`.
+    """
+    def decorator(func):
+        def _timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing(name, time.time() - started)
+        return wraps(func)(_timed)
+    return decorator
@@ -42,3 +42,14 @@ class Lyrics(VersionsModel):
 
     def __unicode__(self):
         return self.text
+
+class Label(VersionsModel):
+    name = models.CharField(max_length=50, unique=True)
+    country = models.CharField(max_length=2)
+    catalog_prefix = models.CharField(max_length=10)
+
+    class Meta:
+        unique_together = (('country', 'catalog_prefix',),)
+
+    def __unicode__(self):
+        return self.name
@@ -12,6 +12,7 @@ INSTALLED_APPS=(
     'django.contrib.auth',
     'django.contrib.sessions',
     'versions',
+    'versions.backends.database',
     'versions.tests',
     )
 VERSIONS_REPOSITORIES = {
@@ -1,24 +1,36 @@
 from __future__ import with_statement
 
+import cPickle as pickle
+import datetime
+import decimal
+import os
 import random
 import shutil
+import tempfile
 import threading
 import time
+import zlib
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
+from versions import codec
 from versions.base import revision
-from versions.exceptions import VersionDoesNotExist, VersionsException, VersionsManagementException
-from versions.tests.models import Artist, Album, Song, Lyrics, Venue
+from versions.cache import SnapshotCache, snapshot_cache
+from versions.exceptions import VersionDoesNotExist, VersionsCommitError, VersionsException, VersionsManagementException
+from versions.tests.models import Artist, Album, Song, Lyrics, Venue, Label
 
 class VersionsTestCase(TestCase):
     def setUp(self):
         for key, configs in settings.VERSIONS_REPOSITORIES.items():
             shutil.rmtree(configs['local'], ignore_errors=True)
+        # Drop any repository handles and snapshots left over from a previous test.
+        revision._state.reset()
+        snapshot_cache.clear()
 
     def tearDown(self):
         for key, configs in settings.VERSIONS_REPOSITORIES.items():
@@ -276,6 +288,227 @@ class VersionsModelTestCase(VersionsTestCase):
         self.assertEqual(list(Artist.objects.version(first_revision).get(pk=queen.pk).albums.all()), [a_kind_of_magic, journey_album])
         self.assertEqual(list(Artist.objects.version(second_revision).get(pk=queen.pk).albums.all()), [a_kind_of_magic])
 
+    def test_revision_retrieval_in_bulk(self):
+        with revision:
+            artists = []
+            for x in xrange(150):
+                artist = Artist(name='Artist %s' % x)
+                artist.save()
+                artists.append(artist)
+
+        first_revision = revision.latest_transactions['default']
+
+        with revision:
+            for artist in artists[::2]:
+                artist.name = '%s (Remastered)' % artist.name
+                artist.save()
+            artists[1].delete()
+
+        second_revision = revision.latest_transactions['default']
+
+        self.assertEqual([ x.name for x in Artist.objects.version(first_revision).order_by('pk') ], [ 'Artist %s' % x for x in xrange(150) ])
+        self.assertEqual([ x.name for x in Artist.objects.version(second_revision).order_by('pk') ], [ x.name for x in artists if x.pk != artists[1].pk ])
+
+    def test_version_users(self):
+        from django.contrib.auth.models import AnonymousUser, User
+        from django.db import connection
+        freddie = User.objects.create(username='freddie')
+        queen = Artist(name='Queen')
+        for x in xrange(3):
+            with revision:
+                revision.user = x and freddie or AnonymousUser()
+                queen.name = 'Queen %s' % x
+                queen.save()
+
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            versions = list(Artist.objects.versions(queen))
+            self.assertEqual(len(connection.queries), 1)
+            self.assertEqual([ x.user.username for x in versions ], ['freddie', 'freddie', ''])
+            self.assertEqual(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = False
+        self.assertTrue(isinstance(versions[2].user, AnonymousUser))
+
+    def test_history_pagination(self):
+        queen = Artist(name='Queen')
+        for x in xrange(5):
+            with revision:
+                queen.name = 'Queen %s' % x
+                queen.save()
+
+        history = Artist.objects.versions(queen)
+        revisions = [ x.revision for x in revision[Artist._versions_options.repository].versions(revision.item_path(Artist, queen.pk)) ]
+        self.assertEqual(len(history), 5)
+        self.assertEqual([ x.revision for x in history[:2] ], revisions[:2])
+        self.assertEqual([ x.revision for x in history[1:3] ], revisions[1:3])
+        self.assertEqual([ x.revision for x in history[3:] ], revisions[3:])
+        self.assertEqual(history[4].revision, revisions[4])
+        self.assertEqual(history[-1].revision, revisions[-1])
+        self.assertRaises(IndexError, lambda: history[5])
+        self.assertEqual([ x.revision for x in history.reverse()[:2] ], revisions[::-1][:2])
+
+        self.assertEqual(history.filter(before=revisions[1]).count(), 3)
+        self.assertEqual([ x.revision for x in history.filter(after=revisions[3], before=revisions[0]) ], revisions[1:3])
+        self.assertEqual(history.filter(since=history[0].date).count(), len([ x for x in history if x.date >= history[0].date ]))
+        self.assertEqual(len(history.filter(since=history[0].date + datetime.timedelta(days=1))), 0)
+        self.assertEqual(history.filter(until=history[0].date).count(), 5)
+        self.assertEqual(history, Artist.objects.versions(queen))
+        self.assertEqual(list(history), list(Artist.objects.versions(queen)))
+
+    def test_skip_unchanged(self):
+        self.assertSkipUnchanged()
+
+    def test_database_skip_unchanged(self):
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['backend'] = 'versions.backends.database'
+        revision._repos.pop('default', None)
+        try:
+            self.assertSkipUnchanged()
+        finally:
+            configs['backend'] = 'versions.backends.hg'
+            revision._repos.pop('default', None)
+
+    def assertSkipUnchanged(self):
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['skip_unchanged'] = True
+        try:
+            with revision:
+                queen = Artist(name='Queen')
+                queen.save()
+                bowie = Artist(name='David Bowie')
+                bowie.save()
+            first_revision = revision.latest_transactions['default']
+            self.assertEqual(revision.latest_skipped, {})
+
+            # Saving the artists again without any changes does not commit anything.
+            with revision:
+                queen.save()
+                bowie.save()
+            self.assertEqual(revision.latest_transactions, {})
+            self.assertEqual(revision.latest_skipped, {'default': 2})
+
+            # The committed versions are read back from the backend when they are not cached.
+            snapshot_cache.clear()
+            with revision:
+                queen.save()
+                bowie.name = 'Bowie'
+                bowie.save()
+            self.assertNotEqual(revision.latest_transactions['default'], first_revision)
+            self.assertEqual(revision.latest_skipped, {'default': 1})
+            self.assertEqual(len(Artist.objects.versions(queen)), 1)
+            self.assertEqual(len(Artist.objects.versions(bowie)), 2)
+        finally:
+            del configs['skip_unchanged']
+
+    def test_batched_related_ids(self):
+        from versions import stats
+        freddie = User.objects.create(username='freddie')
+        with revision:
+            queen = Artist(name='Queen')
+            queen.save()
+            queen.fans.add(freddie)
+            albums = []
+            for x in xrange(10):
+                album = Album(artist=queen, title='Album %s' % x)
+                album.save()
+                albums.append(album)
+                for y in xrange(x % 3):
+                    Song(album=album, title='Song %s-%s' % (x, y)).save()
+            venue = Venue(name='Wembley')
+            venue.save()
+            venue.artists.add(queen)
+
+        # Saving every album looks up their songs with a single query.
+        collector = stats.get_collector()
+        collector.reset()
+        with revision:
+            for album in Album.objects.all():
+                album.title = '%s (Remastered)' % album.title
+                album.save()
+            Artist.objects.get(pk=queen.pk).save()
+        counters = collector.snapshot()['counters']
+        self.assertEqual(counters.get('revision.data.related_queries', 0), 0)
+        # The songs of the albums, and the albums, fans, venues and recent venues of the artist.
+        self.assertEqual(counters['revision.data.related_batch_queries'], 5)
+
+        for album in albums:
+            self.assertEqual(revision.version(album)['related']['songs'], sorted([ x.pk for x in album.songs.all() ]))
+        self.assertEqual(revision.version(queen)['related']['albums'], [ x.pk for x in albums ])
+        self.assertEqual(revision.version(queen)['related']['fans'], [freddie.pk])
+        self.assertEqual(revision.version(queen)['related']['venues'], [venue.pk])
+        self.assertEqual(revision.version(queen)['related']['recent_venues'], [])
+
+    def test_many_to_many_bulk_ids(self):
+        from django.db import connection
+        with revision:
+            artists = []
+            for x in xrange(20):
+                artist = Artist(name='Artist %s' % x)
+                artist.save()
+                artists.append(artist)
+            venue = Venue(name='Wembley')
+            venue.save()
+            venue.artists.add(artists[0])
+
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            with revision:
+                venue.artists.add(*[ x.pk for x in artists[1:] ])
+                # The artists, and their current venues, are each read with a single query.
+                selects = [ x['sql'] for x in connection.queries if x['sql'].startswith('SELECT') ]
+                self.assertEqual(len([ x for x in selects if '"tests_artist"."id" IN' in x ]), 1)
+                self.assertEqual(len([ x for x in selects if 'FROM "tests_venue_artists" WHERE "artist_id" IN' in x ]), 1)
+                self.assertTrue(len(selects) < len(artists) - 1)
+        finally:
+            settings.DEBUG = False
+
+        self.assertEqual(revision.version(venue)['related']['artists'], [ x.pk for x in artists ])
+        for artist in artists:
+            self.assertEqual(revision.version(artist)['related']['venues'], [venue.pk])
+
+        def add_missing_artist():
+            with revision:
+                venue.artists.add(12345)
+        self.assertRaises(Artist.DoesNotExist, add_missing_artist)
+
+    def test_unique_placeholders(self):
+        from django.db import connection
+        with revision:
+            emi = Label(name='EMI', country='GB', catalog_prefix='PCS')
+            emi.save()
+            parlophone = Label(name='Parlophone', country='GB', catalog_prefix='PMC')
+            parlophone.save()
+        with revision:
+            emi.delete()
+            parlophone.delete()
+
+        # A new object reuses the deleted object it conflicts with, found with a single query.
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            with revision:
+                label = Label(name='EMI', country='US', catalog_prefix='ST')
+                label.save()
+                self.assertEqual(len([ x for x in connection.queries if x['sql'].startswith('SELECT "tests_label"."id"') ]), 1)
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(label.pk, emi.pk)
+
+        # Fields unique together are matched before the unique fields.
+        with revision:
+            label = Label(name='Parlophone Records', country='GB', catalog_prefix='PMC')
+            label.save()
+        self.assertEqual(label.pk, parlophone.pk)
+        self.assertEqual(Label.objects.get(pk=parlophone.pk).name, 'Parlophone Records')
+
+        with revision:
+            label = Label(name='Capitol', country='US', catalog_prefix='T')
+            label.save()
+        self.assertEqual(Label.objects.count(), 3)
+
 class PublishedModelTestCase(VersionsTestCase):
     def test_staged_edits(self):
         with revision:
@@ -478,6 +711,842 @@ class VersionsOptionsTestCase(VersionsTestCase):
         data = revision.data(a_kind_of_magic)
         self.assertEqual(data['field'].keys(), ['_versions_status', 'title'])
 
+    def test_snapshot_plan(self):
+        self.assertEqual(sorted(Artist._versions_plan.fields), ['_versions_status', 'name'])
+        self.assertEqual(sorted(Album._versions_plan.fields), ['_versions_status', 'title'])
+        self.assertEqual(sorted([ x[0] for x in Artist._versions_plan.relations ]), ['albums', 'fans', 'recent_venues', 'venues'])
+        self.assertEqual(sorted([ x[0] for x in Lyrics._versions_plan.relations ]), [])
+
+class VersionsCacheTestCase(VersionsTestCase):
+    def test_lru_eviction(self):
+        cache = SnapshotCache(max_bytes=10)
+        cache.set('a', '1234')
+        cache.set('b', '1234')
+        self.assertEqual(cache.get('a'), '1234')
+        # Adding `c` exceeds the budget, so the least recently used entry (`b`) is evicted.
+        cache.set('c', '1234')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), '1234')
+        # Values larger than the whole budget are never cached.
+        cache.set('d', '12345678901')
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.stats(), {'entries': 2, 'size': 8, 'max_bytes': 10, 'hits': 2, 'misses': 2, 'evictions': 1})
+
+    def test_historical_reads_are_cached(self):
+        with revision:
+            queen = Artist(name='Queen')
+            queen.save()
+
+        first_revision = revision.latest_transactions['default']
+
+        self.assertEqual(Artist.objects.version('tip').get(pk=queen.pk).name, 'Queen')
+        hits = snapshot_cache.hits
+        self.assertEqual(Artist.objects.version(first_revision).get(pk=queen.pk).name, 'Queen')
+        self.assertEqual(snapshot_cache.hits, hits + 1)
+
+        with revision:
+            queen.name = 'Queen + Paul Rodgers'
+            queen.save()
+
+        # `tip` is resolved before consulting the cache, so it never returns stale data.
+        self.assertEqual(Artist.objects.version('tip').get(pk=queen.pk).name, 'Queen + Paul Rodgers')
+        self.assertEqual(Artist.objects.version(first_revision).get(pk=queen.pk).name, 'Queen')
+
+class VersionsStatsTestCase(VersionsTestCase):
+    def test_memory_collector(self):
+        from versions import signals, stats
+        collector = stats.get_collector()
+        collector.reset()
+        recorded = []
+        def stat_recorded(sender, name, kind, value, **kwargs):
+            recorded.append((name, kind,))
+        signals.stat_recorded.connect(stat_recorded)
+        try:
+            with revision:
+                queen = Artist(name='Queen')
+                queen.save()
+                Album(artist=queen, title='A Night at the Opera').save()
+            rev = Artist.objects.versions(queen)[0].revision
+            Artist.objects.version(rev).get(pk=queen.pk)
+            Artist.objects.version(rev).get(pk=queen.pk)
+        finally:
+            signals.stat_recorded.disconnect(stat_recorded)
+
+        snapshot = collector.snapshot()
+        for name in ('revision.stage', 'revision.serialize', 'revision.deserialize', 'revision.data.related', 'backend.commit', 'backend.versions', 'hg.lock_wait'):
+            self.assertTrue(snapshot['timings'][name]['count'] > 0, name)
+        self.assertEqual(snapshot['timings']['backend.commit']['count'], 1)
+        self.assertEqual(snapshot['timings']['revision.stage']['count'], 2)
+        self.assertEqual(snapshot['counters']['cache.misses'], 1)
+        self.assertEqual(snapshot['counters']['cache.hits'], 1)
+        self.assertEqual(snapshot['cache_hit_ratio'], 0.5)
+        self.assertTrue(('backend.commit', 'timing',) in recorded)
+        self.assertTrue(('cache.hits', 'counter',) in recorded)
+
+    def test_logging_collector(self):
+        import logging
+        from versions import stats
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        handler = ListHandler()
+        log = logging.getLogger('versions')
+        log.addHandler(handler)
+        old_level = log.level
+        log.setLevel(logging.INFO)
+        try:
+            collector = stats.LoggingCollector(interval=3600)
+            collector.timing('backend.commit', 0.25)
+            collector.incr('cache.hits')
+            self.assertEqual(handler.messages, [])
+            collector.export()
+        finally:
+            log.removeHandler(handler)
+            log.setLevel(old_level)
+        self.assertEqual(handler.messages, [
+            'versions stats: cache.hits count=1',
+            'versions stats: backend.commit count=1 total=250.0ms mean=250.00ms max=250.00ms',
+            'versions stats: cache hit ratio=1.000',
+            ])
+        self.assertEqual(collector.snapshot()['counters'], {})
+
+class ReversedCodec(codec.BaseCodec):
+    identifier = 'r'
+
+    def dumps(self, data):
+        return pickle.dumps(data)[::-1]
+
+    def loads(self, payload):
+        return pickle.loads(payload[::-1])
+
+class VersionsCodecTestCase(VersionsTestCase):
+    def test_codecs(self):
+        data = {
+            'field': {'name': u'Queen', 'time_modified': datetime.datetime(1986, 6, 2, 12, 30, 15, 500), 'price': decimal.Decimal('9.99')},
+            'related': {'albums': [1, 2, 3]},
+            }
+        for name in ('pickle', 'json'):
+            for compress in (False, True):
+                self.assertEqual(codec.decode(codec.encode(data, name, compress)), data)
+
+        # Legacy snapshots are plain pickles, and uncompressed pickles are still written that way.
+        self.assertEqual(codec.encode(data, 'pickle'), pickle.dumps(data))
+        self.assertEqual(codec.decode(pickle.dumps(data)), data)
+
+        # The json codec is deterministic, regardless of dictionary ordering.
+        self.assertEqual(codec.encode({'a': 1, 'b': 2}, 'json'), codec.encode(dict([('b', 2), ('a', 1)]), 'json'))
+        self.assertRaises(VersionsException, codec.decode, codec.encode(data, 'json')[:2] + chr(codec.FORMAT_VERSION + 1) + codec.encode(data, 'json')[3:])
+
+    def test_custom_codec_decoding(self):
+        data = {'field': {'name': u'Queen'}, 'related': {}}
+        payload = codec.HEADER_MAGIC + ReversedCodec.identifier + chr(codec.FORMAT_VERSION) + chr(0) + ReversedCodec().dumps(data)
+
+        # Snapshots written with a configured codec are decoded before anything was encoded with it.
+        name = 'versions.tests.tests.ReversedCodec'
+        codec._codecs.pop(name, None)
+        settings.VERSIONS_CODECS = [name]
+        try:
+            self.assertEqual(codec.decode(payload), data)
+        finally:
+            del settings.VERSIONS_CODECS
+            codec._codecs.pop(name, None)
+
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['codec'] = name
+        try:
+            self.assertEqual(codec.decode(payload), data)
+        finally:
+            del configs['codec']
+            codec._codecs.pop(name, None)
+        self.assertRaises(VersionsException, codec.decode, payload)
+
+    def test_repository_codec(self):
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['codec'] = 'json'
+        configs['compress'] = True
+        try:
+            with revision:
+                queen = Artist(name='Queen')
+                queen.save()
+
+            first_revision = revision.latest_transactions['default']
+            self.assertTrue(revision['default'].version(revision.item_path(Artist, queen.pk)).startswith(codec.HEADER_MAGIC))
+            self.assertEqual(Artist.objects.version(first_revision).get(pk=queen.pk).name, 'Queen')
+        finally:
+            del configs['codec']
+            del configs['compress']
+
+class VersionsSetupTestCase(VersionsTestCase):
+    def test_batched_baseline(self):
+        self.assertBatchedBaseline()
+
+    def test_git_batched_baseline(self):
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['backend'] = 'versions.backends.git'
+        revision._repos.pop('default', None)
+        try:
+            self.assertBatchedBaseline()
+        finally:
+            configs['backend'] = 'versions.backends.hg'
+            revision._repos.pop('default').close()
+
+    def assertBatchedBaseline(self):
+        with revision:
+            for x in xrange(5):
+                Artist(name='Artist %s' % x).save()
+
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            call_command('versions_setup', 'tests.Artist', batch_size=2, checkpoint_dir=checkpoint_dir, verbosity=0)
+
+            artists = list(Artist.objects.order_by('pk'))
+            # Five artists committed two per changeset creates three baseline changesets.
+            self.assertEqual([ len(Artist.objects.versions(x)) for x in artists ], [2, 2, 2, 2, 2])
+            self.assertEqual(Artist.objects.versions(artists[0]), Artist.objects.versions(artists[1]))
+            self.assertNotEqual(Artist.objects.versions(artists[1]), Artist.objects.versions(artists[2]))
+
+            # Resuming from a completed checkpoint does not commit anything new.
+            call_command('versions_setup', 'tests.Artist', batch_size=2, checkpoint_dir=checkpoint_dir, verbosity=0)
+            self.assertEqual([ len(Artist.objects.versions(x)) for x in artists ], [2, 2, 2, 2, 2])
+        finally:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+class VersionsBackendTestCase(VersionsTestCase):
+    def assertVersionMany(self, repository):
+        first_revision = repository.commit({'a/1': 'one', 'a/2': 'two'})
+        second_revision = repository.commit({'a/2': 'two (edited)', 'a/3': 'three'})
+
+        self.assertEqual(repository.version_many(['a/1', 'a/2', 'a/3', 'a/4'], rev=first_revision), {'a/1': 'one', 'a/2': 'two'})
+        self.assertEqual(repository.version_many(['a/1', 'a/2', 'a/3', 'a/4'], rev=second_revision), {'a/1': 'one', 'a/2': 'two (edited)', 'a/3': 'three'})
+        self.assertEqual(repository.version_many(['a/2', 'a/3']), dict([ (x, repository.version(x)) for x in ('a/2', 'a/3') ]))
+
+    def assertVersionsListing(self, repository):
+        revisions = [ repository.commit({'a/1': 'one %s' % x, 'a/%s' % (x + 2): 'other'}) for x in xrange(5) ]
+        revisions = [ str(x) for x in revisions ]
+        listing = lambda **kwargs: [ x.revision for x in repository.versions('a/1', **kwargs) ]
+
+        self.assertEqual(listing(), revisions[::-1])
+        self.assertEqual(listing(reverse=True), revisions)
+        self.assertEqual(listing(limit=2), revisions[:2:-1])
+        self.assertEqual(listing(limit=2, reverse=True), revisions[:2])
+        self.assertEqual(listing(before=revisions[3]), revisions[2::-1])
+        self.assertEqual(listing(before=revisions[3], limit=2), revisions[2:0:-1])
+        self.assertEqual(listing(after=revisions[1], before=revisions[4], reverse=True), revisions[2:4])
+        self.assertEqual(listing(after=revisions[4]), [])
+        self.assertEqual(listing(limit=2, offset=1), revisions[3:1:-1])
+        self.assertEqual(listing(offset=3, reverse=True), revisions[3:])
+        self.assertEqual(listing(before=revisions[4], limit=1, offset=1), [revisions[2]])
+        self.assertEqual(repository.count('a/1'), 5)
+        self.assertEqual(repository.count('a/1', after=revisions[0], before=revisions[4]), 3)
+        self.assertEqual([ x.revision for x in repository.versions('a/3') ], [revisions[1]])
+
+        # Unknown bounds are reported the same way by every backend.
+        self.assertRaises(VersionDoesNotExist, listing, before='f' * 40)
+        self.assertRaises(VersionDoesNotExist, listing, after='f' * 40)
+        self.assertRaises(VersionDoesNotExist, repository.count, 'a/1', before='f' * 40)
+
+    def test_hg_version_many(self):
+        self.assertVersionMany(revision['default'])
+        self.assertEqual([ sorted(x[4]) for x in revision['default'].changesets() ], [['a/1', 'a/2'], ['a/2', 'a/3']])
+
+    def test_hg_versions_listing(self):
+        self.assertVersionsListing(revision['default'])
+
+    def test_database_versions_listing(self):
+        from versions.backends.database.base import Repository
+        self.assertVersionsListing(Repository('database'))
+
+    def test_hg_handle_pool(self):
+        from versions.backends.hg.base import Repository
+        repository = revision['default']
+        repository.commit({'a/1': 'one'})
+        local_repo = repository._local_repo
+        revision._state.reset()
+        self.assertTrue(repository._local_repo is local_repo)
+
+        # Commits made through another handle, as another process would, are seen when a pooled handle is reused.
+        handle = repository._handle
+        revision._state.repositories = {}
+        other_repository = Repository('other', repository.local)
+        second_revision = other_repository.commit({'a/1': 'one (edited)'})
+        handle.release()
+        self.assertTrue(repository._local_repo is local_repo)
+        self.assertEqual(repository.resolve(), second_revision)
+        self.assertEqual(repository.version('a/1'), 'one (edited)')
+
+    def test_hg_remote_sync(self):
+        from mercurial import hg
+        from versions.backends.hg.base import LogUI, Repository
+        local = tempfile.mkdtemp()
+        try:
+            remote_path = os.path.join(local, 'remote')
+            hg.repository(LogUI(), remote_path, create=True)
+            remote_tip = lambda: hg.repository(LogUI(), remote_path)['tip'].hex()
+            repository = Repository('synced', os.path.join(local, 'local'), remote_path, options={'push_commits': 3})
+
+            repository.commit({'a/1': 'one'})
+            repository.commit({'a/1': 'two'})
+            self.assertEqual(repository.sync_lag()['commits'], 2)
+            self.assertNotEqual(remote_tip(), repository.resolve())
+            third_revision = repository.commit({'a/1': 'three'})
+            self.assertEqual(repository.sync_lag(), {'commits': 0, 'seconds': 0})
+            self.assertEqual(remote_tip(), third_revision)
+
+            # Changes pushed to the remote by other repositories are pulled before committing.
+            other_repository = Repository('other', remote_path)
+            other_revision = other_repository.commit({'a/2': 'other'})
+            repository.commit({'a/1': 'four'})
+            self.assertEqual(repository.version('a/2'), 'other')
+            self.assertEqual(repository.sync_lag()['commits'], 1)
+            repository.sync()
+            self.assertEqual(remote_tip(), repository.resolve())
+
+            repository = Repository('synced', repository.local, remote_path, options={'push_commits': 100, 'push_interval': 0})
+            self.assertEqual(repository.commit({'a/1': 'five'}), remote_tip())
+
+            # Held back commits are pushed once the interval has passed, without waiting for another commit.
+            repository = Repository('synced', repository.local, remote_path, options={'push_commits': 100, 'push_interval': 0.2})
+            sixth_revision = repository.commit({'a/1': 'six'})
+            self.assertNotEqual(remote_tip(), sixth_revision)
+            deadline = time.time() + 10
+            while repository.sync_lag()['commits'] and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(remote_tip(), sixth_revision)
+            self.assertEqual(repository.sync_lag()['commits'], 0)
+        finally:
+            shutil.rmtree(local, ignore_errors=True)
+
+    def test_hg_held_back_commits_merged(self):
+        from mercurial import hg
+        from versions import stats
+        from versions.backends.hg.base import LogUI, Repository
+        local = tempfile.mkdtemp()
+        try:
+            remote_path = os.path.join(local, 'remote')
+            hg.repository(LogUI(), remote_path, create=True)
+            Repository('initial', os.path.join(local, 'initial'), remote_path).commit({'a/1': 'one', 'a/2': 'two'})
+            repository = Repository('held', os.path.join(local, 'held'), remote_path, options={'push_commits': 100})
+            other_repository = Repository('other', os.path.join(local, 'other'), remote_path)
+
+            # Another writer pushes while this repository holds a commit back.
+            repository.commit({'a/1': 'one (held back)'})
+            other_revision = other_repository.commit({'a/2': 'two (other)', 'a/3': 'three'})
+            repository.commit({'a/4': 'four'})
+            self.assertEqual(repository.version_many(['a/1', 'a/2', 'a/3', 'a/4']), {'a/1': 'one (held back)', 'a/2': 'two (other)', 'a/3': 'three', 'a/4': 'four'})
+            self.assertEqual(len(repository._local_repo.heads()), 1)
+
+            collector = stats.get_collector()
+            collector.reset()
+            repository.sync()
+            self.assertEqual(repository.sync_lag()['commits'], 0)
+            self.assertEqual(collector.snapshot()['counters']['hg.pushed_commits'], 3)
+            self.assertEqual(collector.snapshot()['timings']['hg.sync_lag']['count'], 1)
+            remote_repo = hg.repository(LogUI(), remote_path)
+            self.assertEqual(len(remote_repo.heads()), 1)
+            self.assertEqual(remote_repo['tip'].hex(), repository.resolve())
+            self.assertEqual(remote_repo['tip']['a/1'].data(), 'one (held back)')
+            self.assertEqual(remote_repo['tip']['a/2'].data(), 'two (other)')
+        finally:
+            revision._state.reset()
+            shutil.rmtree(local, ignore_errors=True)
+
+    def test_database_version_many(self):
+        from versions.backends.database.base import Repository
+        self.assertVersionMany(Repository('database'))
+
+    def test_database_binary_payloads(self):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Revision
+        repository = Repository('database')
+
+        binary = zlib.compress('Bohemian Rhapsody' * 10) + '\xff\x00\xfe'
+        first_revision = repository.commit({'a/1': binary, 'a/2': 'Under Pressure' * 100})
+        self.assertEqual(repository.version('a/1'), binary)
+        self.assertEqual(Revision.objects.get(path='a/2').codec, 'zlib')
+        self.assertEqual(repository.version_many(['a/1', 'a/2']), {'a/1': binary, 'a/2': 'Under Pressure' * 100})
+
+        # Revisions written before payloads were stored in binary are still readable.
+        legacy = Revision(changeset=Revision.objects.get(path='a/1').changeset, path='a/3', data=u'Killer Queen' * 100)
+        legacy.save()
+        self.assertEqual(repository.version('a/3'), 'Killer Queen' * 100)
+
+    def test_database_heads(self):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Head
+        repository = Repository('database')
+
+        first_revision = repository.commit({'a/1': 'one', 'a/2': 'two'})
+        second_revision = repository.commit({'a/2': 'two (edited)'})
+        self.assertEqual(dict(Head.objects.values_list('path', 'changeset')), {'a/1': first_revision, 'a/2': second_revision})
+        self.assertEqual(repository.version('a/2'), 'two (edited)')
+        self.assertEqual(repository.version('a/2', rev=first_revision), 'two')
+        self.assertRaises(VersionDoesNotExist, repository.version, 'a/3')
+
+    def test_database_interleaved_heads(self):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Changeset, Head
+        repository = Repository('database')
+        first, second = Changeset.objects.create(), Changeset.objects.create()
+
+        # The changeset with the lower id finishing last does not move the heads backwards.
+        repository._update_heads(second.pk, ['a/1'])
+        repository._update_heads(first.pk, ['a/1', 'a/2'])
+        self.assertEqual(dict(Head.objects.values_list('path', 'changeset')), {'a/1': second.pk, 'a/2': first.pk})
+
+        # A concurrent commit inserting the head of a new path first is updated instead.
+        insert_rows = repository._insert_rows
+        def interleaved_insert_rows(model, field_names, rows):
+            if model is Head and not Head.objects.filter(path='a/3').count():
+                Head.objects.create(path='a/3', changeset=first)
+            return insert_rows(model, field_names, rows)
+        repository._insert_rows = interleaved_insert_rows
+        repository._update_heads(second.pk, ['a/2', 'a/3', 'a/4'])
+        self.assertEqual(dict(Head.objects.values_list('path', 'changeset')), {'a/1': second.pk, 'a/2': second.pk, 'a/3': second.pk, 'a/4': second.pk})
+
+    def test_database_batched_inserts(self):
+        from django.db import connection
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Revision
+        repository = Repository('database', options={'insert_batch_size': 100})
+
+        changes = dict([ ('a/%s' % x, 'Song %s' % x) for x in xrange(250) ])
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            rev = repository.commit(changes)
+            inserts = [ x for x in connection.queries if x['sql'].startswith('INSERT INTO %s' % connection.ops.quote_name(Revision._meta.db_table)) ]
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(Revision.objects.filter(changeset__pk=rev).count(), 250)
+        self.assertEqual(repository.version_many(changes.keys(), rev=rev), changes)
+
+        # Databases without multi-row inserts execute a single-row insert for every revision instead.
+        repository.multi_row_inserts = lambda: False
+        rev = repository.commit(dict([ (x, 'Edited %s' % y) for x, y in changes.items() ]))
+        self.assertEqual(Revision.objects.filter(changeset__pk=rev).count(), 250)
+        self.assertEqual(repository.version('a/249', rev=rev), 'Edited Song 249')
+
+    def test_database_changeset_parents(self):
+        from django.db import connection
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Changeset
+        repository = Repository('database')
+
+        first_revision = repository.commit({'a/1': 'one'})
+        second_revision = repository.commit({'a/1': 'one (edited)', 'a/2': 'two'})
+        third_revision = repository.commit({'a/1': 'one (edited again)'})
+        self.assertEqual(Changeset.objects.get(pk=first_revision).parent_changeset_id, None)
+        self.assertEqual(Changeset.objects.get(pk=third_revision).parent_changeset_id, second_revision)
+
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            parents = [ x.parent.revision for x in repository.versions('a/1')[:2] ]
+            self.assertEqual(len(connection.queries), 1)
+
+            connection.queries = []
+            history = repository.history('a/1')
+            self.assertEqual(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(parents, [str(second_revision), str(first_revision)])
+        self.assertEqual([ (x['revision'], x['parent']) for x in history ], [(str(third_revision), str(second_revision)), (str(second_revision), str(first_revision)), (str(first_revision), None)])
+        self.assertEqual(history[0]['message'], revision.message)
+
+    def test_database_resolve(self):
+        from django.db import connection
+        from versions.backends.database.base import Repository
+        # Without serialized commits, a changeset with a lower id can still commit, so no revision is cached.
+        repository = Repository('database')
+        first_revision = repository.commit({'a/1': 'one'})
+        self.assertEqual(repository.resolve(first_revision), None)
+
+        repository = Repository('database', options={'serialize_commits': True})
+        self.assertEqual(repository.resolve(first_revision), first_revision)
+
+        # The latest revisions are read through the heads, without looking the tip up first, and
+        # the tip is only looked up again for changesets after the latest one known to be committed.
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.assertEqual(repository.resolve(), None)
+            self.assertEqual(repository.resolve(str(first_revision)), first_revision)
+            self.assertEqual(len(connection.queries), 0)
+        finally:
+            settings.DEBUG = False
+
+        # Changesets that were not committed yet are not resolved, so reads of them are not cached.
+        self.assertEqual(repository.resolve(first_revision + 1), None)
+        second_revision = repository.commit({'a/1': 'one (edited)'})
+        self.assertEqual(repository.resolve(second_revision), second_revision)
+
+    def test_database_tip(self):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Changeset, Tip
+        repository = Repository('database', options={'serialize_commits': True})
+
+        first_revision = repository.commit({'a/1': 'one'})
+        second_revision = repository.commit({'a/1': 'one (edited)'})
+        self.assertEqual(Tip.objects.get().changeset_id, second_revision)
+        self.assertEqual(Changeset.objects.get(pk=second_revision).parent_changeset_id, first_revision)
+
+        # Commits that were not serialized do not move the tip, but are still the parent of the next one.
+        Tip.objects.all().delete()
+        unserialized_revision = Repository('database').commit({'a/1': 'one (unserialized)'})
+        self.assertEqual(Tip.objects.count(), 0)
+        third_revision = repository.commit({'a/1': 'one (edited again)'})
+        self.assertEqual(Changeset.objects.get(pk=third_revision).parent_changeset_id, unserialized_revision)
+        self.assertEqual(Tip.objects.get().changeset_id, third_revision)
+
+    def test_git_backend(self):
+        from versions.backends.git.base import Repository
+        local = tempfile.mkdtemp()
+        repository = Repository('git', os.path.join(local, 'history.git'))
+        try:
+            self.assertRaises(VersionDoesNotExist, repository.version, 'a/1')
+            self.assertEqual(list(repository.versions('a/1')), [])
+            self.assertVersionMany(repository)
+            self.assertEqual([ sorted(x[4]) for x in repository.changesets() ], [['a/1', 'a/2'], ['a/2', 'a/3']])
+
+            versions = list(repository.versions('a/2'))
+            self.assertEqual(len(versions), 2)
+            self.assertEqual(versions[0].parent, versions[1])
+            self.assertEqual(versions[1].parent, None)
+            self.assertEqual(versions[0].message, revision.message)
+            self.assertEqual(repository.version('a/2', rev=versions[1].revision), 'two')
+            self.assertEqual(len(list(repository.versions('a/1'))), 1)
+
+            # A second handle on the same repository (as another process would have) continues the same history.
+            other_repository = Repository('git', repository.local)
+            third_revision = other_repository.commit({'a/1': 'one (edited)'})
+            self.assertEqual(repository.resolve('tip'), third_revision)
+            self.assertEqual(repository.version('a/1'), 'one (edited)')
+            self.assertEqual(list(repository.versions('a/1'))[0].parent, list(repository.versions('a/2'))[0])
+            other_repository.close()
+        finally:
+            repository.close()
+            shutil.rmtree(local, ignore_errors=True)
+
+    def test_git_bulk_commits(self):
+        from versions.backends.git import base
+        from versions.backends.git.base import Repository
+        local = tempfile.mkdtemp()
+        repository = Repository('git', os.path.join(local, 'history.git'))
+        pack_dir = os.path.join(repository.local, 'objects', 'pack')
+        gc_interval = base.GC_INTERVAL
+        try:
+            repository.commit({'a/1': 'zero'})
+            packs = len([ x for x in os.listdir(pack_dir) if x.endswith('.pack') ])
+
+            # Commits made in bulk are only checkpointed once, into a single packfile (instead of
+            # loose objects, which git fast-import writes for checkpoints of fewer than 100 objects).
+            repository.begin_bulk()
+            revisions = [ repository.commit({'a/1': 'Song %s' % x, 'a/%s' % (x + 2): 'Song %s' % x}) for x in xrange(50) ]
+            repository.end_bulk()
+            self.assertEqual(len([ x for x in os.listdir(pack_dir) if x.endswith('.pack') ]), packs + 1)
+            self.assertEqual(repository.resolve(), revisions[-1])
+            self.assertEqual(repository.version('a/1'), 'Song 49')
+            self.assertEqual(repository.version('a/1', rev=revisions[0]), 'Song 0')
+            self.assertEqual(len(list(repository.versions('a/1'))), 51)
+
+            # Loose objects and small packfiles are packed with `git gc --auto` every few commits.
+            base.GC_INTERVAL = 2
+            calls = []
+            git = repository._git
+            def recording_git(*args):
+                calls.append(args)
+                return git(*args)
+            repository._git = recording_git
+            repository.commit({'a/1': 'one'})
+            repository.commit({'a/1': 'two'})
+            self.assertEqual([ x for x in calls if x[0] == 'gc' ], [('gc', '--auto', '--quiet')])
+        finally:
+            base.GC_INTERVAL = gc_interval
+            repository.close()
+            shutil.rmtree(local, ignore_errors=True)
+
+    def test_git_versions_listing(self):
+        from versions.backends.git.base import Repository
+        local = tempfile.mkdtemp()
+        repository = Repository('git', os.path.join(local, 'history.git'))
+        try:
+            self.assertVersionsListing(repository)
+        finally:
+            repository.close()
+            shutil.rmtree(local, ignore_errors=True)
+
+class VersionsDatabaseUpgradeTestCase(TransactionTestCase):
+    """
+    Schema changes commit the current transaction on some databases, so the upgrade is tested outside of one.
+    """
+    def tearDown(self):
+        from versions.backends.database.models import Changeset, Head, Revision, Tip
+        Tip.objects.all().delete()
+        Head.objects.all().delete()
+        Revision.objects.all().delete()
+        Changeset.objects.all().delete()
+
+    def test_database_upgrade(self):
+        from versions.backends.database.base import Repository
+        from versions.backends.database.models import Changeset, Head, Revision, Tip
+        repository = Repository('database')
+
+        # Revisions written by earlier releases have neither a binary payload nor a head.
+        changeset = Changeset(message='Legacy')
+        changeset.save()
+        Revision(changeset=changeset, path='a/1', data=u'Killer Queen' * 100).save()
+        second_changeset = Changeset(message='Legacy')
+        second_changeset.save()
+        self.assertEqual(repository.version('a/1'), 'Killer Queen' * 100)
+        self.assertEqual(repository.version_many(['a/1']), {'a/1': 'Killer Queen' * 100})
+
+        call_command('versions_database_upgrade', verbosity=0)
+        legacy = Revision.objects.get(path='a/1')
+        self.assertEqual((legacy.data, legacy.codec), ('', 'zlib'))
+        self.assertEqual(Head.objects.get(path='a/1').changeset, changeset)
+        self.assertEqual(Changeset.objects.get(pk=second_changeset.pk).parent_changeset, changeset)
+        self.assertEqual(Tip.objects.get().changeset, second_changeset)
+        self.assertEqual(repository.version('a/1'), 'Killer Queen' * 100)
+
+class VersionsShardingTestCase(VersionsTestCase):
+    def setUp(self):
+        super(VersionsShardingTestCase, self).setUp()
+        settings.VERSIONS_REPOSITORIES['default']['shards'] = 3
+        self.local = settings.VERSIONS_REPOSITORIES['default']['local']
+
+    def tearDown(self):
+        settings.VERSIONS_REPOSITORIES['default']['local'] = self.local
+        del settings.VERSIONS_REPOSITORIES['default']['shards']
+        for key in revision._repos.keys():
+            if key != 'default':
+                del revision._repos[key]
+        super(VersionsShardingTestCase, self).tearDown()
+
+    def test_sharded_repositories(self):
+        with revision:
+            artists = [ Artist(name='Artist %s' % x) for x in xrange(6) ]
+            for artist in artists:
+                artist.save()
+        first_revision = revision.latest_transactions['default']
+        self.assertEqual(len(first_revision.split('+')), 3)
+        shards = set([ revision.repository_path(Artist, x.pk) for x in artists ])
+        self.assertTrue(len(shards) > 1)
+        self.assertEqual(set([ x for x in revision.latest_transactions if x != 'default' ]), shards)
+        for artist in artists:
+            self.assertTrue(os.path.exists(os.path.join(self.local, revision.repository_path(Artist, artist.pk).split('.')[1])))
+
+        with revision:
+            for artist in artists:
+                artist.name = '%s (edited)' % artist.name
+                artist.save()
+
+        self.assertEqual([ len(Artist.objects.versions(x)) for x in artists ], [2] * 6)
+        self.assertEqual(sorted([ x.name for x in Artist.objects.version(first_revision).all() ]), [ 'Artist %s' % x for x in xrange(6) ])
+        self.assertEqual(Artist.objects.version(first_revision).get(pk=artists[0].pk).name, 'Artist 0')
+        self.assertEqual(Artist.objects.version('tip').get(pk=artists[0].pk).name, 'Artist 0 (edited)')
+
+        # Reshard the history into two shards, and read it back from them.
+        destination = tempfile.mkdtemp()
+        try:
+            call_command('versions_reshard', 'default', shards=2, destination=os.path.join(destination, 'history'), verbosity=0)
+            settings.VERSIONS_REPOSITORIES['default'].update({'local': os.path.join(destination, 'history'), 'shards': 2})
+            for key in revision._repos.keys():
+                if key != 'default':
+                    del revision._repos[key]
+            revision._state.reset()
+
+            self.assertEqual([ len(Artist.objects.versions(x)) for x in artists ], [2] * 6)
+            self.assertEqual([ x.name for x in Artist.objects.version('tip').filter(pk__in=[ x.pk for x in artists ]).order_by('pk') ], [ 'Artist %s (edited)' % x for x in xrange(6) ])
+            oldest = Artist.objects.versions(artists[0])[1]
+            self.assertEqual(Artist.objects.version(oldest.revision).get(pk=artists[0].pk).name, 'Artist 0')
+            self.assertEqual(sorted([ x.name for x in Artist.objects.version(oldest.revision).all() ]), [ 'Artist %s' % x for x in xrange(6) ])
+
+            # Each logical changeset is replayed as one commit to each of the new shards.
+            changeset_ids = [ [ x[1] for x in revision[y].changeset_ids() ] for y in revision.shard_keys('default') ]
+            self.assertEqual([ len(x) for x in changeset_ids ], [2, 2])
+            self.assertEqual(changeset_ids[0], changeset_ids[1])
+        finally:
+            shutil.rmtree(destination, ignore_errors=True)
+
+    def assertCrossShardReads(self):
+        with revision:
+            artists = [ Artist(name='Artist %s' % x) for x in xrange(6) ]
+            for artist in artists:
+                artist.save()
+        with revision:
+            for artist in artists:
+                artist.name = '%s (edited)' % artist.name
+                artist.save()
+        with revision:
+            artists[0].name = 'Artist 0 (edited again)'
+            artists[0].save()
+
+        # A revision listed in the history of an object stands for the whole logical changeset,
+        # in every shard.
+        other = [ x for x in artists if revision.repository_path(Artist, x.pk) != revision.repository_path(Artist, artists[0].pk) ][0]
+        oldest, middle = [ x.revision for x in Artist.objects.versions(other).reverse() ]
+        self.assertTrue('+' not in oldest)
+        self.assertEqual(sorted([ x.name for x in Artist.objects.version(oldest).all() ]), [ 'Artist %s' % x for x in xrange(6) ])
+        self.assertEqual(sorted([ x.name for x in Artist.objects.version(middle).all() ]), [ 'Artist %s (edited)' % x for x in xrange(6) ])
+        latest = Artist.objects.versions(artists[0])[0].revision
+        self.assertEqual(Artist.objects.version(latest).get(pk=other.pk).name, '%s' % other.name)
+        self.assertEqual(Artist.objects.version(latest).get(pk=artists[0].pk).name, 'Artist 0 (edited again)')
+
+        self.assertRaises(VersionDoesNotExist, lambda: list(Artist.objects.version('1' * 40).all()))
+        self.assertRaises(VersionDoesNotExist, lambda: list(Artist.objects.version('+'.join([oldest, oldest])).all()))
+
+        # Once the tip of a shard moves, only the changesets committed since are listed.
+        listed = []
+        for key in revision.shard_keys('default'):
+            repository = revision[key]
+            def changeset_ids(since=None, changeset_ids=repository.changeset_ids):
+                changesets = list(changeset_ids(since=since))
+                listed.extend(changesets)
+                return changesets
+            repository.changeset_ids = changeset_ids
+        try:
+            with revision:
+                other.name = '%s (edited again)' % other.name
+                other.save()
+            latest = Artist.objects.versions(other)[0].revision
+            self.assertEqual(Artist.objects.version(latest).get(pk=artists[0].pk).name, 'Artist 0 (edited again)')
+            self.assertEqual(len(listed), 1)
+        finally:
+            for key in revision.shard_keys('default'):
+                del revision[key].changeset_ids
+
+    def test_cross_shard_reads(self):
+        self.assertCrossShardReads()
+
+    def test_git_cross_shard_reads(self):
+        configs = settings.VERSIONS_REPOSITORIES['default']
+        configs['backend'] = 'versions.backends.git'
+        try:
+            self.assertCrossShardReads()
+        finally:
+            configs['backend'] = 'versions.backends.hg'
+            for key in revision._repos.keys():
+                if key != 'default':
+                    revision._repos[key].close()
+                    del revision._repos[key]
+
+    def test_concurrent_shard_commits(self):
+        from mercurial import localrepo
+        commitctx = localrepo.localrepository.commitctx
+        lock = threading.Lock()
+        active = [0]
+        overlapped = threading.Event()
+        def concurrent_commitctx(repo, *args, **kwargs):
+            lock.acquire()
+            try:
+                active[0] += 1
+                if active[0] > 1:
+                    overlapped.set()
+            finally:
+                lock.release()
+            try:
+                # Wait for the commit to another shard to start, instead of finishing first.
+                overlapped.wait(5)
+                return commitctx(repo, *args, **kwargs)
+            finally:
+                lock.acquire()
+                active[0] -= 1
+                lock.release()
+
+        localrepo.localrepository.commitctx = concurrent_commitctx
+        try:
+            with revision:
+                for x in xrange(6):
+                    Artist(name='Artist %s' % x).save()
+        finally:
+            localrepo.localrepository.commitctx = commitctx
+        self.assertTrue(overlapped.isSet())
+        self.assertTrue(len([ x for x in revision.latest_transactions if x.startswith('default.') ]) > 1)
+
+    def test_parallel_commits(self):
+        from django.contrib.auth.models import User
+        freddie = User.objects.create(username='freddie')
+        with revision:
+            revision.user = freddie
+            revision.message = 'Sharded'
+            artists = [ Artist(name='Artist %s' % x) for x in xrange(6) ]
+            for artist in artists:
+                artist.save()
+        for artist in artists:
+            version = Artist.objects.versions(artist)[0]
+            self.assertEqual((version.user, version.message), (freddie, 'Sharded'))
+
+        # Commits to the other shards are kept when one of them fails.
+        failing = revision.repository_path(Artist, artists[0].pk)
+        shutil.rmtree(revision[failing].local)
+        open(revision[failing].local, 'w').close()
+        try:
+            with revision:
+                for artist in artists:
+                    artist.name = '%s (edited)' % artist.name
+                    artist.save()
+        except VersionsCommitError, e:
+            self.assertEqual(e.errors.keys(), [failing])
+            self.assertEqual(sorted(e.transactions.keys()), sorted([ x for x in revision.shard_keys('default') if x != failing ]))
+            self.assertEqual(e.transactions, revision.latest_transactions)
+        else:
+            self.fail('The commit to %s did not fail.' % failing)
+        os.remove(revision[failing].local)
+        for artist in artists:
+            if revision.repository_path(Artist, artist.pk) != failing:
+                self.assertEqual(Artist.objects.versions(artist)[0].message, revision.message)
+
+class VersionsSpoolTestCase(VersionsTestCase):
+    def setUp(self):
+        super(VersionsSpoolTestCase, self).setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        settings.VERSIONS_REPOSITORIES['default'].update({'async': True, 'spool_dir': self.spool_dir})
+
+    def tearDown(self):
+        revision._spools.pop('default').close()
+        del settings.VERSIONS_REPOSITORIES['default']['async']
+        del settings.VERSIONS_REPOSITORIES['default']['spool_dir']
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        super(VersionsSpoolTestCase, self).tearDown()
+
+    def test_async_commits(self):
+        queen = Artist(name='Queen')
+        for x in xrange(5):
+            with revision:
+                revision.message = 'Edit %s' % x
+                queen.name = 'Queen %s' % x
+                queen.save()
+        self.assertEqual(revision.latest_transactions, {})
+
+        self.assertEqual(revision.drain(), [])
+        self.assertEqual([ x.message for x in Artist.objects.versions(queen) ], [ 'Edit %s' % x for x in xrange(4, -1, -1) ])
+        self.assertEqual(Artist.objects.version('tip').get(pk=queen.pk).name, 'Queen 4')
+        self.assertEqual(os.listdir(self.spool_dir), ['failed', 'spool.lock'])
+
+    def test_async_commit_failures(self):
+        from versions import signals
+        failed = []
+        def commit_failed(sender, repository, job, exception, **kwargs):
+            failed.append((repository, os.path.basename(job),))
+        signals.commit_failed.connect(commit_failed)
+
+        spool = revision.spool('default')
+        f = open(os.path.join(self.spool_dir, '0-corrupt.job'), 'w')
+        f.write('corrupt')
+        f.close()
+        try:
+            failures = revision.drain()
+        finally:
+            signals.commit_failed.disconnect(commit_failed)
+        self.assertEqual([ x[0] for x in failures ], ['0-corrupt.job'])
+        self.assertEqual(failed, [('default', '0-corrupt.job',)])
+        self.assertEqual(os.listdir(spool.failed_directory), ['0-corrupt.job'])
+
 class VersionsThreadedTestCase(VersionsTestCase):
     def test_concurrent_edits(self):
         @transaction.commit_on_success